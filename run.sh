@@ -1,5 +1,8 @@
 # mysql -u root -p --default-character-set=utf8mb4 --force vinsrare < vendor/management/files/source.sql
 
+# Or without a MySQL server, straight from the dump
+# python3 manage.py read products customers orders purchase-orders --dump vendor/management/files/source.sql
+
 # python3 manage.py delete orders
 # python3 manage.py delete orders
 # python3 manage.py delete orders
@@ -14,18 +17,24 @@
 # python3 manage.py read products
 # python3 manage.py read orders
 
-python3 manage.py sync products
-python3 manage.py sync products
+# Nightly: only what changed in Zen Cart since the last read
+# python3 manage.py read products customers orders purchase-orders --incremental
+# python3 manage.py sync products customers orders
+# python3 manage.py sync products customers orders --changed --dirty
+# python3 manage.py sync inventory
+
+# Or all three at once, orders start as soon as their customer and products exist
+# python3 manage.py sync all
+
 python3 manage.py sync products
 python3 manage.py sync customers
-python3 manage.py sync customers
-python3 manage.py sync customers
-python3 manage.py sync orders
-python3 manage.py sync orders
 python3 manage.py sync orders
 
 python3 manage.py sync product-status
 
+# Shopify vs local: missing, orphaned, duplicated and drifted records
+# python3 manage.py verify products customers orders --mark
+
 python3 manage.py export suppliers
 python3 manage.py export purchase-orders
 python3 manage.py export shipments
@@ -1,20 +1,150 @@
+import os
 import re
+import time
+import queue
+import threading
 from pathlib import Path
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
 import pgeocode
 
+FILEDIR = f"{Path(__file__).resolve().parent.parent}/vendor/management/files"
 
-def thread(rows, function):
-    with ThreadPoolExecutor(max_workers=20) as executor:
-        future_to_row = {executor.submit(
-            function, index, row): row for index, row in enumerate(rows)}
+# GeoNames US.txt (tab separated) or a copy of pgeocode's cached US.txt
+ZIP_DATASET = os.getenv('ZIP_DATASET', f"{FILEDIR}/US.txt")
 
-        for future in as_completed(future_to_row):
+
+class Progress:
+    def __init__(self, label, interval=10):
+        self.label = label
+        self.interval = interval
+        self.lock = threading.Lock()
+
+        self.started = time.monotonic()
+        self.reported = self.started
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.failures = []
+
+    @property
+    def in_flight(self):
+        return self.submitted - self.completed - self.failed
+
+    def done(self, index, row, error=None):
+        with self.lock:
+            if error is None:
+                self.completed += 1
+            else:
+                self.failed += 1
+                self.failures.append((index, row, error))
+
+            now = time.monotonic()
+            if now - self.reported >= self.interval:
+                self.reported = now
+                self.report()
+
+    def report(self):
+        elapsed = time.monotonic() - self.started
+        rate = (self.completed + self.failed) / elapsed if elapsed else 0
+
+        print(f"{self.label}: {self.completed} completed, {self.failed} failed, "
+              f"{self.in_flight} in flight, {rate:.1f}/s over {elapsed:.0f}s")
+
+
+class Throttle:
+    # At most `rate` calls per second across all threads, None for no limit
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next = time.monotonic()
+
+    def wait(self):
+        if not self.rate:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next, now)
+            self.next = slot + 1 / self.rate
+
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def thread(rows, function, workers=20, backlog=None, label="Rows"):
+    # Rows are pulled lazily; at most `backlog` of them are queued or running
+    # at once, so generators and QuerySet.iterator() are never materialized.
+    progress = Progress(label)
+    slots = threading.Semaphore(backlog or workers * 2)
+
+    def run(index, row):
+        try:
+            function(index, row)
+        except Exception as e:
+            print(f"{label} {index} failed: {e}")
+            progress.done(index, row, error=e)
+        else:
+            progress.done(index, row)
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for index, row in enumerate(rows):
+            slots.acquire()
+
+            with progress.lock:
+                progress.submitted += 1
+
+            executor.submit(run, index, row)
+
+    progress.report()
+
+    return progress
+
+
+def prefetch(items, depth=2):
+    # Run a generator on a background thread, at most `depth` items ahead of
+    # the consumer, so producing the next item overlaps with using this one.
+    buffer = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stopped.is_set():
             try:
-                future.result()
-            except Exception as e:
-                print(e)
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((done, e))
+        else:
+            put((done, None))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            item, error = buffer.get()
+            if item is done:
+                if error:
+                    raise error
+                return
+            yield item
+    finally:
+        stopped.set()
+        producer.join()
 
 
 def to_text(text):
@@ -68,16 +198,134 @@ def to_handle(text):
         return ""
 
 
+FILE_INDEXES = {}
+FILE_INDEXES_LOCK = threading.Lock()
+
+
+def directory_stamps(directories):
+    stamps = []
+    for directory in directories:
+        try:
+            stamps.append(os.stat(directory).st_mtime_ns)
+        except OSError:
+            stamps.append(None)
+    return stamps
+
+
+def file_index(search_path, check=False):
+    # basename -> paths under search_path, walked once per directory. Every
+    # walked directory's mtime is kept: the top one is checked on each call,
+    # all of them when check is set, and any change rebuilds the index.
+    search_path = str(search_path)
+    stamp = os.stat(search_path).st_mtime_ns
+
+    with FILE_INDEXES_LOCK:
+        cached = FILE_INDEXES.get(search_path)
+        if cached and cached[0] == stamp and (
+                not check or directory_stamps(cached[1]) == cached[2]):
+            return cached[3]
+
+        index = {}
+        directories = []
+        for root, dirs, files in os.walk(search_path):
+            dirs.sort()
+            directories.append(root)
+            for name in sorted(files):
+                index.setdefault(name, []).append(os.path.join(root, name))
+
+        FILE_INDEXES[search_path] = (stamp, directories, directory_stamps(directories), index)
+        return index
+
+
 def find_file(filename, search_path):
-    search_directory = Path(search_path)
-    for path in search_directory.rglob(filename):
-        if path.is_file():
-            return str(path)
-    return None
+    if not filename or not os.path.isdir(search_path):
+        return None
 
+    filename = filename.replace("\\", "/").strip("/")
 
-def get_state_from_zip(zip_code):
-    nomi = pgeocode.Nominatim('us')
-    location = nomi.query_postal_code(zip_code)
+    def lookup(check):
+        paths = file_index(search_path, check=check).get(os.path.basename(filename), [])
+
+        # Names like "roomsets/foo.jpg" must match the trailing directories too
+        if "/" in filename:
+            paths = [path for path in paths
+                     if path.replace(os.sep, "/").endswith(f"/{filename}")]
+
+        return paths[0] if paths else None
+
+    # A miss checks the subdirectories too, a file may have been added below
+    return lookup(check=False) or lookup(check=True)
+
+
+class ZipResolver:
+    # ZIP code -> state name, loaded once and kept as a dict
+
+    def __init__(self, path=ZIP_DATASET):
+        self.path = path
+        self.lock = threading.Lock()
+        self.states = None
+
+    def read(self, path):
+        with open(path, encoding="utf-8") as f:
+            header = f.readline().startswith("country_code")
 
-    return location['state_name']
+        if header:
+            data = pd.read_csv(path, dtype={"postal_code": str},
+                               keep_default_na=False)
+        else:
+            data = pd.read_csv(path, sep="\t", header=None, names=pgeocode.DATA_FIELDS,
+                               dtype={"postal_code": str}, keep_default_na=False)
+
+        return data[['postal_code', 'state_name']]
+
+    def load(self):
+        with self.lock:
+            if self.states is not None:
+                return self.states
+
+            # ZIP_DATASET, then pgeocode's cache. Never downloaded mid-run: a
+            # missing dataset would otherwise leave every state blank offline.
+            cached = os.path.join(pgeocode.STORAGE_DIR, "US.txt")
+            if self.path and os.path.exists(self.path):
+                data = self.read(self.path)
+            elif os.path.exists(cached):
+                data = self.read(cached)
+            else:
+                raise FileNotFoundError(
+                    f"ZIP dataset not found at {self.path} or {cached}. Download "
+                    f"https://download.geonames.org/export/zip/US.zip and extract US.txt "
+                    f"to {self.path}, or point ZIP_DATASET at it.")
+
+            data = data[data['state_name'] != ""].drop_duplicates('postal_code')
+            self.states = dict(zip(data['postal_code'], data['state_name']))
+
+            return self.states
+
+    def normalize(self, zip_code):
+        zip_code = str(zip_code or "").split("-")[0].strip()
+        if zip_code.isdigit():
+            zip_code = zip_code.zfill(5)
+        return zip_code
+
+    def resolve(self, zip_code):
+        return self.load().get(self.normalize(zip_code), "")
+
+    def resolve_many(self, zip_codes):
+        # Resolve a batch with one join, returns {zip_code: state}
+        states = self.load()
+
+        frame = pd.DataFrame({'zip_code': list(set(zip_codes))})
+        if frame.empty:
+            return {}
+
+        frame['postal_code'] = frame['zip_code'].map(self.normalize)
+        frame['state'] = frame['postal_code'].map(states).fillna("")
+
+        return dict(zip(frame['zip_code'], frame['state']))
+
+
+ZIP_RESOLVER = ZipResolver()
+
+
+def get_state_from_zip(zip_code):
+    return ZIP_RESOLVER.resolve(zip_code)
@@ -0,0 +1,183 @@
+import os
+import time
+import random
+import asyncio
+
+from asgiref.sync import sync_to_async
+
+from vendor.models import SyncAttempt
+
+SYNC_MAX_ATTEMPTS = int(os.getenv('SYNC_MAX_ATTEMPTS', 5))
+SYNC_BACKOFF_BASE = float(os.getenv('SYNC_BACKOFF_BASE', 1))
+SYNC_BACKOFF_MAX = float(os.getenv('SYNC_BACKOFF_MAX', 60))
+
+# HTTP codes worth another attempt, anything else in 4xx is final
+RETRYABLE_CODES = [408, 409, 429]
+
+
+class Rejected(Exception):
+    # Shopify refused the record itself, retrying the same payload won't help
+    pass
+
+
+def error_details(e):
+    # (http code, retry-after) from pyactiveresource and aiohttp errors
+    code = getattr(e, 'code', None) or getattr(e, 'status', None)
+
+    retry_after = None
+    response = getattr(e, 'response', None)
+    headers = getattr(response, 'headers', None) or getattr(e, 'headers', None)
+    if headers:
+        headers = {key.lower(): value for key, value in headers.items()}
+        try:
+            retry_after = float(headers.get('retry-after'))
+        except (TypeError, ValueError):
+            pass
+
+    return (int(code) if code else None), retry_after
+
+
+def retryable(e, code):
+    if isinstance(e, Rejected):
+        return False
+    if code and code < 500:
+        return code in RETRYABLE_CODES
+    return True
+
+
+def backoff(attempt, retry_after=None):
+    delay = min(SYNC_BACKOFF_MAX, SYNC_BACKOFF_BASE * 2 ** (attempt - 1))
+    delay += random.uniform(0, delay / 2)
+    return max(delay, retry_after or 0)
+
+
+def last_attempt(entity, record_id):
+    return SyncAttempt.objects.filter(entity=entity, record_id=str(record_id)).order_by('-id').first()
+
+
+def rejected(entity, cast=str):
+    record_ids = SyncAttempt.objects.filter(
+        entity=entity, status="rejected").values_list('record_id', flat=True).distinct()
+    return [cast(record_id) for record_id in record_ids]
+
+
+def ambiguous(attempt):
+    # The request may have reached Shopify: the run died mid-call, or the
+    # connection failed before a status code came back
+    if not attempt:
+        return False
+    return attempt.status == "started" or (attempt.status == "failed" and not attempt.http_code)
+
+
+def record_failure(entry, e):
+    code, retry_after = error_details(e)
+
+    entry.status = "rejected" if isinstance(e, Rejected) else "failed"
+    entry.error = str(e)
+    entry.http_code = code
+    entry.retry_after = retry_after
+    entry.save()
+
+    return code, retry_after
+
+
+def run(entity, record_id, function, reconcile=None, attempts=SYNC_MAX_ATTEMPTS):
+    # Journal every attempt at function() and retry it with exponential
+    # backoff. function() must raise on failure and return the Shopify id.
+    record_id = str(record_id)
+
+    previous = last_attempt(entity, record_id)
+    number = previous.attempt if previous else 0
+
+    if reconcile and ambiguous(previous):
+        shopify_id = reconcile()
+        if shopify_id:
+            SyncAttempt.objects.create(
+                entity=entity, record_id=record_id, attempt=number, status="reconciled", shopify_id=shopify_id)
+            return shopify_id
+
+    for retry in range(attempts):
+        number += 1
+        entry = SyncAttempt.objects.create(
+            entity=entity, record_id=record_id, attempt=number)
+
+        try:
+            shopify_id = function()
+
+        except Exception as e:
+            code, retry_after = record_failure(entry, e)
+
+            if not retryable(e, code) or retry == attempts - 1:
+                raise
+
+            delay = backoff(retry + 1, retry_after)
+            print(
+                f"{entity} {record_id} attempt {number} failed ({code or e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+            # A timeout may still have created the record
+            if reconcile and not code:
+                shopify_id = reconcile()
+                if shopify_id:
+                    SyncAttempt.objects.create(
+                        entity=entity, record_id=record_id, attempt=number, status="reconciled", shopify_id=shopify_id)
+                    return shopify_id
+
+            continue
+
+        entry.status = "succeeded"
+        entry.shopify_id = shopify_id
+        entry.save()
+
+        return shopify_id
+
+
+async def run_async(entity, record_id, function, reconcile=None, attempts=SYNC_MAX_ATTEMPTS):
+    # run() for the async engine: function and reconcile are coroutine
+    # functions, the journal is written from Django's sync thread
+    record_id = str(record_id)
+
+    previous = await sync_to_async(last_attempt)(entity, record_id)
+    number = previous.attempt if previous else 0
+
+    reconciled = sync_to_async(lambda number, shopify_id: SyncAttempt.objects.create(
+        entity=entity, record_id=record_id, attempt=number, status="reconciled", shopify_id=shopify_id))
+
+    if reconcile and ambiguous(previous):
+        shopify_id = await reconcile()
+        if shopify_id:
+            await reconciled(number, shopify_id)
+            return shopify_id
+
+    for retry in range(attempts):
+        number += 1
+        entry = await sync_to_async(SyncAttempt.objects.create)(
+            entity=entity, record_id=record_id, attempt=number)
+
+        try:
+            shopify_id = await function()
+
+        except Exception as e:
+            code, retry_after = await sync_to_async(record_failure)(entry, e)
+
+            if not retryable(e, code) or retry == attempts - 1:
+                raise
+
+            delay = backoff(retry + 1, retry_after)
+            print(
+                f"{entity} {record_id} attempt {number} failed ({code or e}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+            if reconcile and not code:
+                shopify_id = await reconcile()
+                if shopify_id:
+                    await reconciled(number, shopify_id)
+                    return shopify_id
+
+            continue
+
+        entry.status = "succeeded"
+        entry.shopify_id = shopify_id
+        await sync_to_async(entry.save)()
+
+        return shopify_id
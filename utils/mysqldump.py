@@ -0,0 +1,327 @@
+import os
+import re
+import gzip
+import sqlite3
+from decimal import Decimal
+
+from pymysql import converters
+
+from utils.common import FILEDIR
+
+# Reads a mysqldump file straight into a SQLite staging database, so `read`
+# can run its queries without restoring the dump into MySQL first
+
+SOURCE_DUMP = os.getenv('SOURCE_DUMP', f"{FILEDIR}/source.sql")
+STAGING_DB = os.getenv('STAGING_DB', f"{FILEDIR}/source.sqlite3")
+
+# Bumped when staging changes, so older staging files are rebuilt
+STAGING_VERSION = 2
+
+# Every Zen Cart table read.py queries
+SOURCE_TABLES = [
+    "products",
+    "products_description",
+    "products_to_categories",
+    "categories_description",
+    "product_types",
+    "product_vino_extra",
+    "customers",
+    "customers_info",
+    "address_book",
+    "countries",
+    "orders",
+    "orders_status",
+    "orders_status_history",
+    "orders_total",
+    "orders_products",
+    "po_header",
+    "po_details",
+    "po_receipts",
+]
+
+# Staging column types. The *_TEXT ones keep MySQL's text as is (TEXT
+# affinity) and are converted on the way out, the way pymysql converts them.
+MYSQL_TYPES = {
+    "INTEGER": ["tinyint", "smallint", "mediumint", "int", "integer", "bigint", "year"],
+    "REAL": ["float", "double", "real"],
+    "DECIMAL_TEXT": ["decimal", "numeric", "dec", "fixed"],
+    "DATETIME_TEXT": ["datetime", "timestamp"],
+    "DATE_TEXT": ["date"],
+    "TIME_TEXT": ["time"],
+    "BLOB": ["tinyblob", "blob", "mediumblob", "longblob", "binary", "varbinary", "bit"],
+}
+STAGING_TYPES = {mysql_type: staging_type
+                 for staging_type, mysql_types in MYSQL_TYPES.items() for mysql_type in mysql_types}
+
+# MySQL's zero dates are staged as NULL, so they read as None like every
+# other missing date instead of a string among datetimes
+ZERO_DATES = {
+    "DATETIME_TEXT": "0000-00-00",
+    "DATE_TEXT": "0000-00-00",
+}
+
+sqlite3.register_converter("DECIMAL_TEXT", lambda value: Decimal(value.decode()))
+sqlite3.register_converter("DATETIME_TEXT", converters.convert_datetime)
+sqlite3.register_converter("DATE_TEXT", converters.convert_date)
+sqlite3.register_converter("TIME_TEXT", converters.convert_timedelta)
+
+CREATE_TABLE = re.compile(r"CREATE TABLE (?:IF NOT EXISTS )?`(\w+)` \(", re.I)
+COLUMN = re.compile(r"\s*`(\w+)`\s+(\w+)")
+KEY = re.compile(r"\s*(?:PRIMARY |UNIQUE )?KEY\s*(?:`\w+`\s*)?\((.*)\)", re.I)
+KEY_COLUMN = re.compile(r"`(\w+)`")
+INSERT = re.compile(
+    r"(?:INSERT(?:\s+IGNORE)?|REPLACE)\s+INTO\s+`?(\w+)`?\s*(?:\(([^)]*)\)\s*)?VALUES\s*", re.I)
+
+# One value and the "," or ")" after it. Strings are matched unrolled, so
+# long descriptions don't backtrack.
+VALUE = re.compile(r"""\s*(?:
+    (NULL)
+    |(?:_\w+\s*)?'([^'\\]*(?:(?:\\.|'')[^'\\]*)*)'
+    |0x([0-9A-Fa-f]*)
+    |b'([01]*)'
+    |([-+]?[0-9.]+(?:[eE][-+]?[0-9]+)?)
+)\s*([,)])""", re.S | re.I | re.X)
+
+ESCAPE = re.compile(r"\\(.)|''", re.S)
+ESCAPES = {"0": "\x00", "b": "\b", "n": "\n", "r": "\r", "t": "\t", "Z": "\x1a",
+           "%": "\\%", "_": "\\_"}
+
+
+def unescape(text):
+    if "\\" not in text and "''" not in text:
+        return text
+
+    def replace(match):
+        if match.group(0) == "''":
+            return "'"
+        return ESCAPES.get(match.group(1), match.group(1))
+
+    return ESCAPE.sub(replace, text)
+
+
+def to_number(token, staging_type):
+    if staging_type == "INTEGER":
+        try:
+            return int(token)
+        except ValueError:
+            return Decimal(token)
+    if staging_type == "REAL":
+        return float(token)
+    return token
+
+
+def rows(line, pos, types):
+    # Every (...) tuple of an extended INSERT, one list of values at a time
+    length = len(line)
+    while pos < length:
+        while pos < length and line[pos] in " \t\r\n,":
+            pos += 1
+        if pos >= length or line[pos] == ";":
+            return
+        if line[pos] != "(":
+            raise ValueError(f"Unexpected {line[pos:pos + 20]!r} in INSERT")
+        pos += 1
+
+        row = []
+        while True:
+            match = VALUE.match(line, pos)
+            if not match:
+                raise ValueError(f"Unreadable value {line[pos:pos + 20]!r} in INSERT")
+            pos = match.end()
+
+            null, text, hexadecimal, bits, number, separator = match.groups()
+            staging_type = types[len(row)] if len(row) < len(types) else None
+            if null:
+                value = None
+            elif text is not None:
+                value = unescape(text)
+                if staging_type == "BLOB":
+                    value = value.encode()
+                elif staging_type in ZERO_DATES and value.startswith(ZERO_DATES[staging_type]):
+                    value = None
+            elif hexadecimal is not None:
+                value = bytes.fromhex(hexadecimal)
+            elif bits is not None:
+                value = int(bits or "0", 2).to_bytes(max(1, (len(bits) + 7) // 8), "big")
+            else:
+                value = to_number(number, staging_type)
+
+            row.append(value)
+            if separator == ")":
+                break
+
+        yield row
+
+
+def statements(file):
+    # mysqldump writes one statement per line, CREATE TABLE aside, so memory
+    # is bounded by the longest extended INSERT (net_buffer_length)
+    for line in file:
+        match = CREATE_TABLE.match(line)
+        if not match:
+            yield line, None
+            continue
+
+        table = [line]
+        for line in file:
+            table.append(line)
+            if line.startswith(")"):
+                break
+        yield None, (match.group(1), table)
+
+
+def table_schema(lines):
+    columns = []
+    keys = []
+    for line in lines[1:-1]:
+        column = COLUMN.match(line)
+        if column:
+            name, mysql_type = column.groups()
+            columns.append((name, STAGING_TYPES.get(mysql_type.lower(), "TEXT")))
+            continue
+
+        key = KEY.match(line)
+        if key:
+            keys.append(KEY_COLUMN.findall(key.group(1)))
+
+    return columns, keys
+
+
+def quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def stage(path, staging, tables=SOURCE_TABLES):
+    # Dump -> staging database, only the tables we read. Returns {table: rows}.
+    connection = sqlite3.connect(staging)
+    connection.execute("PRAGMA journal_mode = OFF")
+    connection.execute("PRAGMA synchronous = OFF")
+
+    schemas = {}
+    counts = {}
+
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, mode="rt", encoding="utf-8", errors="replace") as file:
+        for line, create in statements(file):
+            if create:
+                table, lines = create
+                if table not in tables:
+                    continue
+
+                columns, keys = table_schema(lines)
+                schemas[table] = (columns, keys)
+                counts[table] = 0
+
+                connection.execute(f"DROP TABLE IF EXISTS {quote(table)}")
+                connection.execute(f"CREATE TABLE {quote(table)} (%s)" % ", ".join(
+                    f"{quote(name)} {staging_type}" for name, staging_type in columns))
+                continue
+
+            match = INSERT.match(line)
+            if not match or match.group(1) not in tables:
+                continue
+
+            table, names = match.groups()
+            if table not in schemas:
+                raise ValueError(f"INSERT into {table} before its CREATE TABLE")
+
+            columns = schemas[table][0]
+            if names:
+                names = KEY_COLUMN.findall(names) or [name.strip() for name in names.split(",")]
+                types = dict(columns)
+                types = [types.get(name) for name in names]
+            else:
+                names = [name for name, staging_type in columns]
+                types = [staging_type for name, staging_type in columns]
+
+            sql = f"INSERT INTO {quote(table)} (%s) VALUES (%s)" % (
+                ", ".join(quote(name) for name in names), ", ".join("?" * len(names)))
+
+            values = list(rows(line, match.end(), types))
+            connection.executemany(sql, values)
+            counts[table] += len(values)
+
+    # The dump's own keys, so the joins in read.py don't scan
+    for table, (columns, keys) in schemas.items():
+        for index, key in enumerate(keys):
+            connection.execute(f"CREATE INDEX {quote(f'{table}_{index}')} ON {quote(table)} (%s)" % ", ".join(
+                quote(name) for name in key))
+
+    connection.commit()
+    connection.close()
+
+    return counts
+
+
+def load(path=SOURCE_DUMP, staging=STAGING_DB, force=False):
+    # Restaged only when the dump changes, so several `read` runs share it
+    stat = os.stat(path)
+    stamp = f"{STAGING_VERSION}:{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    if not force and os.path.exists(staging):
+        connection = sqlite3.connect(staging)
+        try:
+            row = connection.execute("SELECT stamp FROM staged").fetchone()
+        except sqlite3.DatabaseError:
+            row = None
+        finally:
+            connection.close()
+
+        if row and row[0] == stamp:
+            return staging
+
+    print(f"Staging {path}")
+
+    # Built next to the staging database and swapped in, so a failed load
+    # never leaves a half-filled one behind
+    if os.path.exists(f"{staging}.tmp"):
+        os.remove(f"{staging}.tmp")
+
+    counts = stage(path, f"{staging}.tmp")
+    for table, count in counts.items():
+        print(f"{count} {table}")
+
+    missing = [table for table in SOURCE_TABLES if table not in counts]
+    if missing:
+        print(f"Not in the dump: {', '.join(missing)}")
+
+    connection = sqlite3.connect(f"{staging}.tmp")
+    connection.execute("CREATE TABLE staged (stamp TEXT)")
+    connection.execute("INSERT INTO staged VALUES (?)", [stamp])
+    connection.commit()
+    connection.close()
+
+    os.replace(f"{staging}.tmp", staging)
+
+    return staging
+
+
+# Just enough of pymysql's connection for read.py: %s placeholders, dict rows
+# and cursors used as context managers
+
+class Cursor(sqlite3.Cursor):
+    def execute(self, sql, args=None):
+        return super().execute(sql.replace("%s", "?"), args or ())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class Connection(sqlite3.Connection):
+    def cursor(self, cursorclass=None):
+        return super().cursor(Cursor)
+
+
+def to_dict(cursor, row):
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+def connect(staging=STAGING_DB):
+    # Rows are streamed from prefetch()'s thread
+    connection = sqlite3.connect(staging, detect_types=sqlite3.PARSE_DECLTYPES,
+                                 check_same_thread=False, factory=Connection)
+    connection.row_factory = to_dict
+    return connection
@@ -0,0 +1,187 @@
+import re
+from operator import itemgetter
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from utils.common import to_date
+
+# Column-at-a-time versions of common.to_text / to_float / to_int / to_date.
+# Results match the scalar helpers cell for cell. Type checks and masks run
+# over whole columns, the string conversions once per distinct value.
+
+TEXT = "text"
+FLOAT = "float"
+INT = "int"
+DATE = "date"
+FLAG = "flag"
+
+NON_PRINTABLE = re.compile(r'[^\x20-\x7E]+')
+WHITESPACE = re.compile(r'\s+')
+MM_DD_YYYY = re.compile(r'([0-9]{1,2})/([0-9]{1,2})/([0-9]{4})')
+
+
+def column(values):
+    # Keep the original Python objects, pandas would otherwise coerce them
+    if isinstance(values, pd.Series):
+        values = values.to_numpy()
+    if isinstance(values, np.ndarray) and values.dtype == object:
+        return values
+    values = list(values)
+    return np.fromiter(values, dtype=object, count=len(values))
+
+
+def truthy(values):
+    return values.astype(bool)
+
+
+def each_unique(values, function):
+    # Still a Python loop over every cell, but repeated cells (prices, flags,
+    # dates) cost a dict lookup and are converted once. A plain dict, pandas'
+    # hashtable treats strings with NUL bytes as equal.
+    converted = {}
+    for value in values:
+        if value not in converted:
+            converted[value] = function(value)
+    return column(map(converted.__getitem__, values))
+
+
+def clean(value):
+    # Most cells are already printable ASCII with single spaces
+    if not (value.isascii() and value.isprintable()):
+        value = NON_PRINTABLE.sub('', value)
+    if "  " in value:
+        value = WHITESPACE.sub(' ', value)
+    return value.strip()
+
+
+def to_series(values):
+    return pd.Series(values, dtype=object)
+
+
+def text(values):
+    values = column(values)
+    result = np.full(len(values), "", dtype=object)
+
+    # Whole numbers print without a decimal point
+    types = column(map(type, values))
+    whole = np.zeros(len(values), dtype=bool)
+    floats = np.zeros(len(values), dtype=bool)
+    for kind in set(types):
+        if issubclass(kind, int):
+            whole |= types == kind
+        elif issubclass(kind, float):
+            floats |= types == kind
+    if floats.any():
+        numbers = values[floats].astype(float)
+        with np.errstate(invalid='ignore'):
+            whole[floats] = np.isfinite(numbers) & (np.mod(numbers, 1) == 0)
+
+    if whole.any():
+        result[whole] = [str(int(value)) for value in values[whole]]
+
+    strings = truthy(values) & ~whole
+    if strings.any():
+        result[strings] = each_unique(
+            column(map(str, values[strings])), clean)
+
+    return to_series(result)
+
+
+def parse_float(value):
+    # to_float() for text that has already been through to_text()
+    if not value:
+        return 0
+    try:
+        value = round(float(value), 2)
+    except ValueError:
+        value = 0
+    return int(value) if value == int(value) else value
+
+
+def parse_int(value):
+    return int(parse_float(value))
+
+
+def numbers(values, function):
+    values = column(values)
+    result = np.zeros(len(values), dtype=object)
+
+    present = truthy(values)
+    if present.any():
+        result[present] = each_unique(text(values[present]), function)
+
+    return to_series(result)
+
+
+def floats(values):
+    return numbers(values, parse_float)
+
+
+def ints(values):
+    return numbers(values, parse_int)
+
+
+def parse_date(value):
+    # to_date() without strptime for the usual m/d/Y shape
+    match = MM_DD_YYYY.fullmatch(value)
+    if not match:
+        return to_date(value)
+
+    month, day, year = [int(part) for part in match.groups()]
+    try:
+        return date(year, month, day)
+    except ValueError:
+        return None
+
+
+def dates(values):
+    values = column(values)
+    result = np.full(len(values), None, dtype=object)
+
+    present = truthy(values)
+    if present.any():
+        result[present] = each_unique(
+            column(map(str, values[present])), parse_date)
+
+    return to_series(result)
+
+
+def flags(values, true):
+    # to_int(value) == 1 or to_text(value) == "Y" for a whole column
+    cleaned = text(values) if isinstance(true, str) else ints(values)
+    return (cleaned == true).to_numpy(dtype=bool)
+
+
+CONVERTERS = {
+    TEXT: text,
+    FLOAT: floats,
+    INT: ints,
+    DATE: dates,
+}
+
+
+def normalize(rows, columns):
+    # rows: list of dicts from the cursor. columns: {name: TEXT | FLOAT | INT |
+    # DATE | (FLAG, true value)}. Returns new dicts with those columns cleaned,
+    # every other column exactly as the cursor returned it.
+    names = list(columns)
+
+    cleaned = []
+    for name in names:
+        kind = columns[name]
+        values = column(map(itemgetter(name), rows))
+
+        if isinstance(kind, tuple):
+            cleaned.append(flags(values, kind[1]).tolist())
+        else:
+            cleaned.append(CONVERTERS[kind](values).tolist())
+
+    records = []
+    for row, values in zip(rows, zip(*cleaned)):
+        record = dict(row)
+        record.update(zip(names, values))
+        records.append(record)
+
+    return records
@@ -0,0 +1,172 @@
+import threading
+import time
+
+REST = "rest"
+GRAPHQL = "graphql"
+
+# Shopify standard plan defaults (capacity, restore rate per second). They are
+# replaced by the real values as soon as a response reports them.
+BUCKET_DEFAULTS = {
+    REST: (40, 2),
+    GRAPHQL: (1000, 50),
+}
+
+
+class Bucket:
+    def __init__(self, capacity, restore_rate):
+        self.capacity = capacity
+        self.restore_rate = restore_rate
+        self.available = capacity
+        self.updated = time.monotonic()
+
+    def leak(self, now):
+        self.available = min(
+            self.capacity, self.available + (now - self.updated) * self.restore_rate)
+        self.updated = now
+
+    def wait_time(self, cost):
+        cost = min(cost, self.capacity)
+        if self.available >= cost:
+            return 0
+        return (cost - self.available) / self.restore_rate
+
+
+class Scheduler:
+    def __init__(self, tokens, concurrency=None):
+        self.tokens = [token for token in tokens if token]
+        self.lock = threading.Condition()
+
+        # Maximum leases held at once per token, None for no limit
+        self.concurrency = concurrency
+
+        self.buckets = {}
+        self.usage = {}
+        self.in_flight = {}
+        for token in self.tokens:
+            self.in_flight[token] = 0
+            self.buckets[token] = {api: Bucket(*defaults)
+                                   for api, defaults in BUCKET_DEFAULTS.items()}
+            self.usage[token] = {
+                "requests": 0,
+                "cost": 0,
+                "waited": 0.0,
+                "throttled": 0,
+            }
+
+    def reserve(self, cost=1, api=REST, tokens=None):
+        # Pick the token that can afford the cost soonest and debit it right
+        # away, so concurrent callers queue up behind the reservation.
+        if not self.tokens:
+            raise ValueError("No Shopify API tokens configured")
+
+        candidates = tokens
+
+        with self.lock:
+            tokens = self.free_tokens(candidates)
+            while not tokens:
+                self.lock.wait()
+                tokens = self.free_tokens(candidates)
+
+            now = time.monotonic()
+
+            best = None
+            for token in tokens:
+                bucket = self.buckets[token][api]
+                bucket.leak(now)
+                key = (bucket.wait_time(cost), -bucket.available)
+
+                if best is None or key < best[0]:
+                    best = (key, token)
+
+            (wait, _), token = best
+            self._debit(token, cost, api, wait)
+            self.in_flight[token] += 1
+
+            return token, wait
+
+    def free_tokens(self, candidates=None):
+        tokens = candidates or self.tokens
+        if not self.concurrency:
+            return tokens
+        return [token for token in tokens if self.in_flight[token] < self.concurrency]
+
+    def release(self, token):
+        with self.lock:
+            self.in_flight[token] -= 1
+            self.lock.notify()
+
+    def acquire(self, cost=1, api=REST):
+        token, wait = self.reserve(cost=cost, api=api)
+        if wait > 0:
+            time.sleep(wait)
+        return token
+
+    def wait(self, token, cost=1, api=REST):
+        # Further requests made under a token that is already held
+        if token not in self.buckets:
+            return
+
+        with self.lock:
+            bucket = self.buckets[token][api]
+            bucket.leak(time.monotonic())
+            wait = bucket.wait_time(cost)
+            self._debit(token, cost, api, wait)
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def _debit(self, token, cost, api, wait):
+        self.buckets[token][api].available -= cost
+
+        usage = self.usage[token]
+        usage["requests"] += 1
+        usage["cost"] += cost
+        usage["waited"] += wait
+
+    def observe_rest(self, token, header):
+        # X-Shopify-Shop-Api-Call-Limit: "used/limit"
+        if not header or token not in self.buckets:
+            return
+
+        try:
+            used, limit = [int(value) for value in str(header).split("/")]
+        except ValueError:
+            return
+
+        with self.lock:
+            bucket = self.buckets[token][REST]
+            bucket.leak(time.monotonic())
+            bucket.capacity = limit
+            bucket.available = min(bucket.available, limit - used)
+
+    def observe_graphql(self, token, throttle_status):
+        if not throttle_status or token not in self.buckets:
+            return
+
+        with self.lock:
+            bucket = self.buckets[token][GRAPHQL]
+            bucket.leak(time.monotonic())
+            bucket.capacity = throttle_status['maximumAvailable']
+            bucket.restore_rate = throttle_status['restoreRate']
+            bucket.available = min(
+                bucket.available, throttle_status['currentlyAvailable'])
+
+    def throttled(self, token, api=REST, retry_after=None):
+        if token not in self.buckets:
+            return
+
+        with self.lock:
+            bucket = self.buckets[token][api]
+            bucket.leak(time.monotonic())
+            backoff = float(retry_after) if retry_after else 1.0
+            bucket.available = min(
+                bucket.available, -backoff * bucket.restore_rate)
+
+            self.usage[token]["throttled"] += 1
+
+    def report(self):
+        for index, token in enumerate(self.tokens):
+            usage = self.usage[token]
+            print(
+                f"Token {index} (...{token[-4:]}): {usage['requests']} requests, cost {usage['cost']}, "
+                f"waited {usage['waited']:.1f}s, throttled {usage['throttled']}")
@@ -1,25 +1,635 @@
 import os
+import time
 import base64
+import hashlib
+import requests
+from contextlib import contextmanager
 from pathlib import Path
 import shopify
 import json
-from vendor.models import Address, Product, Order
+from pyactiveresource.connection import ClientError
+from utils.scheduler import Scheduler, REST, GRAPHQL
+from utils.common import thread
+from utils.journal import Rejected
+from django.db.models import Exists, OuterRef
+from vendor.models import Address, Product, Order, LineItem
 
 SHOPIFY_API_BASE_URL = os.getenv('SHOPIFY_API_BASE_URL')
 SHOPIFY_API_VERSION = os.getenv('SHOPIFY_API_VERSION')
 SHOPIFY_API_TOKEN = os.getenv('SHOPIFY_API_TOKEN')
 SHOPIFY_API_THREAD_TOKENS = os.getenv('SHOPIFY_API_THREAD_TOKENS')
+SHOPIFY_LOCATION_ID = os.getenv('SHOPIFY_LOCATION_ID', '76827230447')
+SHOPIFY_TOKEN_CONCURRENCY = os.getenv('SHOPIFY_TOKEN_CONCURRENCY')
+SHOPIFY_CURRENCY = os.getenv('SHOPIFY_CURRENCY', 'USD')
 
 FILEDIR = f"{Path(__file__).resolve().parent.parent}/vendor/management/files"
 
+CALL_LIMIT_HEADER = "x-shopify-shop-api-call-limit"
 
-class Processor:
-    def __init__(self, thread=None):
+BULK_POLL_INTERVAL = 2
+
+BULK_QUERY_MUTATION = """
+    mutation bulkOperationRunQuery($query: String!) {
+        bulkOperationRunQuery(query: $query) {
+            bulkOperation {
+                id
+                status
+            }
+            userErrors {
+                field
+                message
+            }
+        }
+    }
+"""
+
+BULK_POLL_QUERY = """
+    query bulkOperation($id: ID!) {
+        node(id: $id) {
+            ... on BulkOperation {
+                id
+                status
+                errorCode
+                objectCount
+                url
+            }
+        }
+    }
+"""
+
+PRODUCT_SET_MUTATION = """
+    mutation productSet($input: ProductSetInput!) {
+        productSet(synchronous: true, input: $input) {
+            product {
+                id
+                handle
+                updatedAt
+                variants(first: 1) {
+                    nodes {
+                        id
+                        inventoryItem {
+                            id
+                        }
+                    }
+                }
+            }
+            userErrors {
+                field
+                message
+            }
+        }
+    }
+"""
+
+PUBLICATIONS_QUERY = """
+    {
+        publications(first: 20) {
+            nodes {
+                id
+                name
+            }
+        }
+    }
+"""
+
+PUBLISH_MUTATION = """
+    mutation publishablePublish($id: ID!, $input: [PublicationInput!]!) {
+        publishablePublish(id: $id, input: $input) {
+            userErrors {
+                field
+                message
+            }
+        }
+    }
+"""
+
+FULFILLMENT_CREATE_MUTATION = """
+    mutation fulfillmentCreateV2($fulfillment: FulfillmentV2Input!) {
+        fulfillmentCreateV2(fulfillment: $fulfillment) {
+            fulfillment {
+                id
+                status
+            }
+            userErrors {
+                field
+                message
+            }
+        }
+    }
+"""
+
+FULFILLMENT_EVENT_MUTATION = """
+    mutation fulfillmentEventCreate($fulfillmentEvent: FulfillmentEventInput!) {
+        fulfillmentEventCreate(fulfillmentEvent: $fulfillmentEvent) {
+            fulfillmentEvent {
+                id
+                status
+                message
+            }
+            userErrors {
+                field
+                message
+            }
+        }
+    }
+"""
+
+PRODUCTS_BULK_QUERY = """
+    {
+        products {
+            edges {
+                node {
+                    id
+                }
+            }
+        }
+    }
+"""
+
+CUSTOMERS_BULK_QUERY = """
+    {
+        customers {
+            edges {
+                node {
+                    id
+                }
+            }
+        }
+    }
+"""
+
+PRODUCT_BY_SKU_QUERY = """
+    query productBySku($query: String!) {
+        productVariants(first: 1, query: $query) {
+            nodes {
+                id
+                inventoryItem {
+                    id
+                }
+                product {
+                    id
+                    handle
+                    updatedAt
+                }
+            }
+        }
+    }
+"""
+
+ORDER_BY_TAG_QUERY = """
+    query orderByTag($query: String!) {
+        orders(first: 1, query: $query) {
+            nodes {
+                id
+            }
+        }
+    }
+"""
+
+ORDERS_BULK_QUERY = """
+    {
+        orders {
+            edges {
+                node {
+                    id
+                }
+            }
+        }
+    }
+"""
+
+ORDER_CREATE_MUTATION = """
+    mutation orderCreate($order: OrderCreateOrderInput!, $options: OrderCreateOptionsInput) {
+        orderCreate(order: $order, options: $options) {
+            order {
+                id
+                name
+            }
+            userErrors {
+                field
+                message
+            }
+        }
+    }
+"""
+
+STAGED_UPLOADS_MUTATION = """
+    mutation stagedUploadsCreate($input: [StagedUploadInput!]!) {
+        stagedUploadsCreate(input: $input) {
+            stagedTargets {
+                url
+                parameters {
+                    name
+                    value
+                }
+            }
+            userErrors {
+                field
+                message
+            }
+        }
+    }
+"""
+
+BULK_MUTATION_MUTATION = """
+    mutation bulkOperationRunMutation($mutation: String!, $stagedUploadPath: String!) {
+        bulkOperationRunMutation(mutation: $mutation, stagedUploadPath: $stagedUploadPath) {
+            bulkOperation {
+                id
+                status
+            }
+            userErrors {
+                field
+                message
+            }
+        }
+    }
+"""
+
+INVENTORY_SET_QUANTITIES_MUTATION = """
+    mutation inventorySetQuantities($input: InventorySetQuantitiesInput!) {
+        inventorySetQuantities(input: $input) {
+            userErrors {
+                field
+                message
+            }
+        }
+    }
+"""
+
+# Aliased productUpdate calls per product-status request
+PRODUCT_STATUS_BATCH_SIZE = 25
+
+# Orders still waiting on stock keep their inactive products as drafts
+OPEN_ORDER_STATUSES = ["Partial Shipment", "Pending", "Processing"]
+
+# inventorySetQuantities takes at most 250 quantities per call
+INVENTORY_BATCH_SIZE = 250
+
+# Zen Cart statuses with nothing left to ship, created already fulfilled
+HISTORY_STATUSES = ["Delivered", "Cancelled"]
+
+COUNTRY_CODES = {
+    "United States": "US",
+    "Canada": "CA",
+    "United Kingdom": "GB",
+    "France": "FR",
+    "Germany": "DE",
+    "Italy": "IT",
+    "Switzerland": "CH",
+    "Hong Kong": "HK",
+    "Singapore": "SG",
+    "Japan": "JP",
+    "Australia": "AU",
+    "Mexico": "MX",
+}
+
+US_STATE_CODES = {
+    "Alabama": "AL", "Alaska": "AK", "Arizona": "AZ", "Arkansas": "AR", "California": "CA",
+    "Colorado": "CO", "Connecticut": "CT", "Delaware": "DE", "District of Columbia": "DC",
+    "Florida": "FL", "Georgia": "GA", "Hawaii": "HI", "Idaho": "ID", "Illinois": "IL",
+    "Indiana": "IN", "Iowa": "IA", "Kansas": "KS", "Kentucky": "KY", "Louisiana": "LA",
+    "Maine": "ME", "Maryland": "MD", "Massachusetts": "MA", "Michigan": "MI", "Minnesota": "MN",
+    "Mississippi": "MS", "Missouri": "MO", "Montana": "MT", "Nebraska": "NE", "Nevada": "NV",
+    "New Hampshire": "NH", "New Jersey": "NJ", "New Mexico": "NM", "New York": "NY",
+    "North Carolina": "NC", "North Dakota": "ND", "Ohio": "OH", "Oklahoma": "OK", "Oregon": "OR",
+    "Pennsylvania": "PA", "Puerto Rico": "PR", "Rhode Island": "RI", "South Carolina": "SC",
+    "South Dakota": "SD", "Tennessee": "TN", "Texas": "TX", "Utah": "UT", "Vermont": "VT",
+    "Virginia": "VA", "Washington": "WA", "West Virginia": "WV", "Wisconsin": "WI", "Wyoming": "WY",
+}
+
+# custom.* metafield definitions in the store, by key
+METAFIELD_TYPES = {
+    "min_order_qty": "number_integer",
+    "order_increment": "number_integer",
+    "pre_arrival": "boolean",
+    "wine_searcher": "boolean",
+    "biodynamic": "boolean",
+    "depth": "number_decimal",
+    "width": "number_decimal",
+    "height": "number_decimal",
+    **{key: "single_line_text_field" for key in [
+        "warehouse_location", "year", "country", "appellation", "rating_ws", "rating_wa", "rating_vm",
+        "rating_bh", "rating_jg", "rating_js", "size", "cellar_tracker_id", "varietal", "region",
+        "sub_region", "vineyard", "disgorged", "dosage", "alc", "rating_jd", "rating_jm", "rating_wh",
+        "rating_vr", "additional_notes", "gender"]},
+}
+
+SCHEDULER = Scheduler(
+    SHOPIFY_API_THREAD_TOKENS.split(",") if SHOPIFY_API_THREAD_TOKENS else [SHOPIFY_API_TOKEN],
+    concurrency=int(SHOPIFY_TOKEN_CONCURRENCY) if SHOPIFY_TOKEN_CONCURRENCY else None)
+
+
+def last_response():
+    return shopify.ShopifyResource.connection.response
+
+
+def observe(token, previous=None):
+    # Only a response from a REST call made in this session, GraphQL calls
+    # leave the connection's last response in place
+    response = last_response()
+    if response is None or response is previous:
+        return
+
+    headers = {key.lower(): value for key, value in response.headers.items()}
+    SCHEDULER.observe_rest(token, headers.get(CALL_LIMIT_HEADER))
+
+
+@contextmanager
+def session(cost=1, api=REST):
+    token = SCHEDULER.acquire(cost=cost, api=api)
+
+    try:
+        with shopify.Session.temp(SHOPIFY_API_BASE_URL, SHOPIFY_API_VERSION, token):
+            previous = last_response()
+            try:
+                yield token
+            except ClientError as e:
+                if e.code == 429:
+                    headers = {key.lower(): value for key,
+                               value in e.response.headers.items()}
+                    SCHEDULER.throttled(
+                        token, api=REST, retry_after=headers.get("retry-after"))
+                raise
+            finally:
+                observe(token, previous)
+    finally:
+        SCHEDULER.release(token)
+
+
+def graphql(token, query, variables=None, cost=10):
+    SCHEDULER.wait(token, cost=cost, api=GRAPHQL)
+
+    response = json.loads(shopify.GraphQL().execute(query, variables=variables))
+
+    SCHEDULER.observe_graphql(token, response.get(
+        'extensions', {}).get('cost', {}).get('throttleStatus'))
+
+    for error in response.get('errors', []):
+        if error.get('extensions', {}).get('code') == "THROTTLED":
+            SCHEDULER.throttled(token, api=GRAPHQL)
+
+    return response
+
+
+def report():
+    SCHEDULER.report()
+
+
+def to_id(gid):
+    return int(str(gid).rsplit("/", 1)[-1])
+
+
+def to_gid(resource, id):
+    return f"gid://shopify/{resource}/{id}"
+
+
+def to_product_index(shopify_product):
+    variant = shopify_product['variants']['nodes'][0]
+
+    return {
+        "id": to_id(shopify_product['id']),
+        "handle": shopify_product['handle'],
+        "updated_at": shopify_product['updatedAt'],
+        "variant_id": to_id(variant['id']),
+        "inventory_item_id": to_id(variant['inventoryItem']['id']),
+    }
 
-        self.api_token = SHOPIFY_API_TOKEN
 
-        if thread != None:
-            self.api_token = SHOPIFY_API_THREAD_TOKENS.split(",")[thread % 5]
+def to_order_tag(order_id):
+    # Idempotency marker, so an order created by a crashed run can be found again
+    return f"zencart-{order_id}"
+
+
+def to_money(amount):
+    return {"shopMoney": {"amount": str(amount or 0), "currencyCode": SHOPIFY_CURRENCY}}
+
+
+def to_mailing_address(address):
+    # REST address dict -> MailingAddressInput. Zen Cart keeps country and
+    # state names, GraphQL wants codes.
+    address = dict(address)
+    country = address.pop('country', None)
+    province = address.pop('province', None)
+
+    name = address.pop('name', None)
+    if name:
+        first_name, _, last_name = str(name).partition(" ")
+        address.setdefault('first_name', first_name)
+        address.setdefault('last_name', last_name)
+
+    address = {
+        "firstName": address.get('first_name'),
+        "lastName": address.get('last_name'),
+        "company": address.get('company'),
+        "address1": address.get('address1'),
+        "address2": address.get('address2'),
+        "city": address.get('city'),
+        "zip": address.get('zip'),
+        "phone": address.get('phone'),
+    }
+
+    country_code = COUNTRY_CODES.get(country)
+    if country_code:
+        address['countryCode'] = country_code
+    elif country:
+        address['country'] = country
+
+    if province and len(province) == 2 and province.isalpha():
+        address['provinceCode'] = province.upper()
+    elif country_code == "US" and US_STATE_CODES.get(province):
+        address['provinceCode'] = US_STATE_CODES[province]
+    elif province:
+        address['province'] = province
+
+    return {key: value for key, value in address.items() if value not in [None, ""]}
+
+
+def to_order_number(name):
+    # "#1001" -> 1001
+    digits = "".join(character for character in str(name) if character.isdigit())
+    return int(digits) if digits else None
+
+
+def to_metafield_value(type, value):
+    if type == "boolean":
+        return "true" if value else "false"
+    if type == "number_integer":
+        return str(int(round(float(value))))
+    if type == "number_decimal":
+        return str(float(value))
+    return str(value)
+
+
+def to_metafield_input(metafield):
+    # Types follow the store's metafield definitions, not the Python value: a
+    # mismatch makes productSet reject the whole product. Keys without an
+    # entry are sent untyped, so Shopify takes the definition's type.
+    type = METAFIELD_TYPES.get(metafield['key'])
+
+    metafield_input = {
+        "namespace": metafield['namespace'],
+        "key": metafield['key'],
+        "value": to_metafield_value(type, metafield['value']),
+    }
+    if type:
+        metafield_input['type'] = type
+
+    return metafield_input
+
+
+def digest(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def changes(fingerprint, stored):
+    # Sections and metafield keys whose digest differs from the last push
+    stored = stored or {}
+
+    sections = [section for section, value in fingerprint.items()
+                if section != 'metafields' and value != stored.get(section)]
+    metafield_keys = [key for key, value in fingerprint.get('metafields', {}).items()
+                      if value != stored.get('metafields', {}).get(key)]
+
+    return sections, metafield_keys
+
+
+def set_metafields(token, owner_id, metafields):
+
+    set_mutation = """
+        mutation metafieldsSet($metafields: [MetafieldsSetInput!]!) {
+            metafieldsSet(metafields: $metafields) {
+                userErrors {
+                    field
+                    message
+                }
+            }
+        }
+    """
+
+    delete_mutation = """
+        mutation metafieldsDelete($metafields: [MetafieldIdentifierInput!]!) {
+            metafieldsDelete(metafields: $metafields) {
+                userErrors {
+                    field
+                    message
+                }
+            }
+        }
+    """
+
+    values = []
+    blanks = []
+    for metafield in metafields:
+        if metafield['value'] in [None, ""]:
+            blanks.append({
+                "ownerId": owner_id,
+                "namespace": metafield['namespace'],
+                "key": metafield['key'],
+            })
+        else:
+            values.append(
+                {"ownerId": owner_id, **to_metafield_input(metafield)})
+
+    errors = []
+
+    # metafieldsSet takes at most 25 metafields per call
+    for index in range(0, len(values), 25):
+        response = graphql(token, set_mutation, variables={
+                           "metafields": values[index:index + 25]})
+        errors += response['data']['metafieldsSet']['userErrors']
+
+    if blanks:
+        response = graphql(token, delete_mutation,
+                           variables={"metafields": blanks})
+        errors += response['data']['metafieldsDelete']['userErrors']
+
+    return errors
+
+
+PUBLICATION_ID = None
+
+
+def get_publication_id(token):
+    global PUBLICATION_ID
+
+    if PUBLICATION_ID is None:
+        response = graphql(token, PUBLICATIONS_QUERY, cost=5)
+
+        for publication in response['data']['publications']['nodes']:
+            if publication['name'] == "Online Store":
+                PUBLICATION_ID = publication['id']
+
+    return PUBLICATION_ID
+
+
+def bulk_query(query):
+
+    with session(cost=0, api=GRAPHQL) as token:
+
+        response = graphql(token, BULK_QUERY_MUTATION,
+                           variables={"query": query})
+
+        result = response['data']['bulkOperationRunQuery']
+        if result['userErrors']:
+            raise Exception(result['userErrors'])
+
+        operation_id = result['bulkOperation']['id']
+
+        while True:
+            time.sleep(BULK_POLL_INTERVAL)
+
+            response = graphql(token, BULK_POLL_QUERY, variables={
+                               "id": operation_id}, cost=1)
+            operation = response['data']['node']
+
+            print(
+                f"Bulk operation {operation['status']}: {operation['objectCount']} objects")
+
+            if operation['status'] == "COMPLETED":
+                url = operation['url']
+                break
+
+            if operation['status'] in ["FAILED", "CANCELED", "EXPIRED"]:
+                raise Exception(
+                    f"Bulk operation {operation_id} {operation['status']}: {operation['errorCode']}")
+
+    # Empty result sets have no file
+    if not url:
+        return
+
+    yield from stream_jsonl(url)
+
+
+def stream_jsonl(url):
+    with requests.get(url, stream=True, timeout=60) as response:
+        response.raise_for_status()
+
+        for line in response.iter_lines():
+            if line:
+                yield json.loads(line)
+
+
+class Processor:
+    def __init__(self, addresses=None):
+        # {address_id: Address} preloaded for a chunk of orders
+        self.addresses = addresses
+
+    def line_items(self, order):
+        # Prefetched line items come from the cache, otherwise one query
+        if 'lineItems' in getattr(order, '_prefetched_objects_cache', {}):
+            return order.lineItems.all()
+        return order.lineItems.select_related('product')
+
+    def shipping_address(self, order):
+        if self.addresses is None:
+            return Address.objects.select_related('customer').get(address_id=order.shipping_address_id)
+
+        shipping_address = self.addresses.get(order.shipping_address_id)
+        if not shipping_address:
+            raise Address.DoesNotExist(
+                f"Address {order.shipping_address_id} does not exist")
+        return shipping_address
 
     def __enter__(self):
         return self
@@ -132,6 +742,126 @@ class Processor:
 
         return variant_data
 
+    def generate_product_set_input(self, product):
+        product_data = self.generate_product_data(product=product)
+        variant_data = self.generate_variant_data(product=product)
+        metafields = self.generate_product_metafields(product=product)
+
+        variant_input = {
+            "optionValues": [{
+                "optionName": "Title",
+                "name": "Default Title",
+            }],
+            "price": str(variant_data['price'] or 0),
+            "taxable": variant_data['taxable'],
+            "inventoryItem": {
+                "sku": variant_data['sku'],
+                "tracked": variant_data['inventory_management'] == "shopify",
+                "measurement": {
+                    "weight": {
+                        "value": variant_data['weight'] or 0,
+                        "unit": "POUNDS",
+                    }
+                },
+            },
+        }
+
+        if variant_data['inventory_management'] == "shopify":
+            variant_input['inventoryQuantities'] = [{
+                "locationId": to_gid("Location", SHOPIFY_LOCATION_ID),
+                "name": "available",
+                "quantity": variant_data['inventory_quantity'] or 0,
+            }]
+
+        product_input = {
+            "title": product_data['title'],
+            "descriptionHtml": product_data['body_html'] or "",
+            "vendor": product_data['vendor'],
+            "productType": product_data['product_type'],
+            "tags": product_data['tags'].split(",") if product_data['tags'] else [],
+            "productOptions": [{
+                "name": "Title",
+                "values": [{"name": "Default Title"}],
+            }],
+            "variants": [variant_input],
+            "metafields": [to_metafield_input(metafield) for metafield in metafields
+                           if metafield['value'] not in [None, ""]],
+        }
+
+        if product.thumbnail:
+            product_input['files'] = [{
+                "originalSource": product.thumbnail,
+                "contentType": "IMAGE",
+                "alt": product_data['title'],
+            }]
+
+        return product_input
+
+    def generate_product_fingerprint(self, product):
+        return {
+            "product": digest(self.generate_product_data(product=product)),
+            "variant": digest(self.generate_variant_data(product=product)),
+            "metafields": {metafield['key']: digest(metafield['value'])
+                           for metafield in self.generate_product_metafields(product=product)},
+        }
+
+    def generate_customer_data(self, customer):
+
+        # Exceptions
+        email = customer.email.replace(" ", "")
+
+        addresses = []
+        for address in customer.addresses.all():
+            address_obj = {
+                "first_name": address.first_name,
+                "last_name": address.last_name,
+                "company": address.company,
+                "address1": address.address1,
+                "address2": address.address2,
+                "city": address.city,
+                "province": address.state,
+                "zip": address.zip,
+                "country": address.country,
+            }
+            if address.address_id == customer.default_address:
+                address_obj['default'] = True
+
+            addresses.append(address_obj)
+
+        customer_data = {
+            "email": email,
+            "phone": customer.phone,
+            "first_name": customer.first_name,
+            "last_name": customer.last_name,
+            "addresses": addresses,
+            "note": customer.note,
+            "tags": customer.tags,
+        }
+
+        if customer.newsletter:
+            customer_data["email_marketing_consent"] = {
+                "state": "subscribed",
+                "opt_in_level": "confirmed_opt_in",
+            }
+        if customer.sms and customer.phone:
+            customer_data["sms_marketing_consent"] = {
+                "state": "subscribed",
+                "opt_in_level": "single_opt_in",
+            }
+
+        return customer_data
+
+    def generate_customer_fingerprint(self, customer):
+        customer_data = self.generate_customer_data(customer=customer)
+        addresses = customer_data.pop('addresses')
+
+        return {
+            "customer": digest(customer_data),
+            "addresses": digest(addresses),
+            "metafields": {metafield['key']: digest(metafield['value'])
+                           for metafield in self.generate_customer_metafields(customer=customer)},
+        }
+
     def generate_customer_metafields(self, customer):
         metafield_keys = [
             'gender',
@@ -141,15 +871,235 @@ class Processor:
         for metafield_key in metafield_keys:
             metafield_value = getattr(customer, metafield_key)
 
-            metafield = {
-                "namespace": "custom",
-                "key": metafield_key,
-                "value": metafield_value
-            }
+            metafield = {
+                "namespace": "custom",
+                "key": metafield_key,
+                "value": metafield_value
+            }
+
+            metafields.append(metafield)
+
+        return metafields
+
+    def generate_order_data(self, order):
+
+        order_data = {}
+
+        # Customer
+        order_data['customer'] = {
+            "id": order.customer.shopify_id
+        }
+        order_data['phone'] = order.customer.phone
+
+        # Line Items
+        line_items = []
+        missing = []
+        for item in self.line_items(order):
+            variant_id = item.product.shopify_variant_id
+            if not variant_id:
+                missing.append(item.product.product_id)
+                continue
+
+            line_items.append({
+                "variant_id": int(variant_id),
+                "price": item.unit_price,
+                "quantity": item.quantity,
+            })
+        order_data['line_items'] = line_items
+
+        # Creating it without them would leave the totals short
+        if missing:
+            raise Rejected(f"Products without a Shopify variant: {', '.join(missing)}")
+
+        # Costs
+        if not order.shipping_price < 0:
+            order_data['shipping_lines'] = [{
+                "title": order.shipping_method or "FedEx",
+                "price": order.shipping_price
+            }]
+        order_data['tax_lines'] = [{
+            'price': order.tax
+        }]
+        order_data['total_price'] = order.total_price
+        if order.order_date:
+            order_data['created_at'] = order.order_date.isoformat()
+
+        # Shipping Address
+        if order.shipping_address_id:
+            try:
+                shipping_address = self.shipping_address(order)
+
+                order_data['shipping_address'] = {
+                    'first_name': shipping_address.first_name,
+                    'last_name': shipping_address.last_name,
+                    'company': shipping_address.company,
+                    'address1': shipping_address.address1,
+                    'address2': shipping_address.address2,
+                    'city': shipping_address.city,
+                    'province': shipping_address.state,
+                    'zip': shipping_address.zip,
+                    'country': shipping_address.country,
+                    'phone': shipping_address.customer.phone
+                }
+            except Exception as e:
+                print(e)
+                pass
+
+        # Billing Address
+        order_data['billing_address'] = {
+            'name': order.billing_name,
+            'company': order.billing_company,
+            'address1': order.billing_address1,
+            'address2': order.billing_address2,
+            'city': order.billing_city,
+            'province': order.billing_state,
+            'zip': order.billing_zip,
+            'country': order.billing_country,
+        }
+
+        # Order Status
+        if order.status == "Cancelled":
+            order_data['fulfillment_status'] = "restocked"
+            order_data['financial_status'] = "refunded"
+        elif order.status == "Delivered":
+            order_data['financial_status'] = "paid"
+        elif order.status == "Partial Shipment":
+            order_data['financial_status'] = "paid"
+        elif order.status == "Pending":
+            order_data['financial_status'] = "pending"
+        elif order.status == "Processing":
+            order_data['financial_status'] = "paid"
+        else:
+            order_data['financial_status'] = "pending"
+
+        # Order Note
+        order_data['note'] = f"Zencart Order ID: {order.order_id}"
+        order_data['tags'] = to_order_tag(order.order_id)
+
+        return order_data
+
+    def generate_order_create_input(self, order):
+        # orderCreate input built from local data only, variant ids included.
+        # Orders with nothing left to ship are created already fulfilled.
+        order_data = self.generate_order_data(order=order)
+
+        line_items = [{
+            "variantId": to_gid("ProductVariant", item['variant_id']),
+            "quantity": item['quantity'],
+            "priceSet": to_money(item['price']),
+        } for item in order_data['line_items']]
+
+        subtotal = sum(float(item['price'] or 0) * item['quantity']
+                       for item in order_data['line_items'])
+
+        order_input = {
+            "customer": {"toAssociate": {"id": to_gid("Customer", order.customer.shopify_id)}},
+            "lineItems": line_items,
+            "taxLines": [{
+                "title": "Tax",
+                "rate": round(order.tax / subtotal, 4) if subtotal else 0,
+                "priceSet": to_money(order.tax),
+            }],
+            "financialStatus": order_data['financial_status'].upper(),
+            "billingAddress": to_mailing_address(order_data['billing_address']),
+            "note": order_data['note'],
+            "tags": [order_data['tags']],
+        }
+
+        if order.customer.phone:
+            order_input['phone'] = order.customer.phone
+
+        # DateTime scalar, Zen Cart order dates are dates only
+        if order.order_date:
+            order_input['processedAt'] = f"{order.order_date.isoformat()}T00:00:00Z"
+
+        for shipping_line in order_data.get('shipping_lines', []):
+            order_input.setdefault('shippingLines', []).append({
+                "title": shipping_line['title'],
+                "priceSet": to_money(shipping_line['price']),
+            })
+
+        if 'shipping_address' in order_data:
+            order_input['shippingAddress'] = to_mailing_address(
+                order_data['shipping_address'])
+
+        # orderCreate has no total, Zen Cart coupons and surcharges are
+        # carried as a discount or an extra line so the total matches
+        shipping = sum(float(shipping_line['price'] or 0)
+                       for shipping_line in order_data.get('shipping_lines', []))
+        difference = round(subtotal + shipping + float(order.tax or 0) - float(order.total_price or 0), 2)
+        if difference > 0:
+            order_input['discountCode'] = {"itemFixedDiscountCode": {
+                "code": "ZENCART",
+                "amountSet": to_money(difference),
+            }}
+        elif difference < 0:
+            line_items.append({
+                "title": "Zen Cart adjustment",
+                "quantity": 1,
+                "priceSet": to_money(-difference),
+                "requiresShipping": False,
+                "taxable": False,
+            })
+
+        if order.status == "Cancelled":
+            order_input['fulfillmentStatus'] = "RESTOCKED"
+        elif order.status == "Delivered":
+            order_input['fulfillmentStatus'] = "FULFILLED"
+            order_input['fulfillment'] = {
+                "locationId": to_gid("Location", SHOPIFY_LOCATION_ID),
+                "shipmentStatus": "DELIVERED",
+                "notifyCustomer": False,
+            }
+
+        return order_input
+
+    def generate_order_create_options(self):
+        return {
+            "sendReceipt": False,
+            "sendFulfillmentReceipt": False,
+            "inventoryBehaviour": "BYPASS",
+        }
+
+    def generate_order_fingerprint(self, order):
+        # Order metafields are not pushed on creation, so they are not tracked
+        return {
+            "order": digest(self.generate_order_data(order=order)),
+        }
+
+    def generate_shipped_items(self, order):
+
+        # Shipped line items by Shopify variant, first match wins
+        shipped = {}
+        for lineItem in self.line_items(order):
+            variant_id = lineItem.product.shopify_variant_id
+            if lineItem.shipped > 0 and variant_id and variant_id not in shipped:
+                shipped[variant_id] = lineItem
+
+        return shipped
+
+    def generate_fulfillment_line_items(self, fo_line_items, shipped):
 
-            metafields.append(metafield)
+        fulfillmentOrderLineItems = []
+        shipped_date = None
+        for foLineItem in fo_line_items:
+            lineItem = shipped.get(str(foLineItem['variant_id']))
+            if not lineItem:
+                continue
 
-        return metafields
+            # Only what has shipped since the last fulfillment
+            fulfillable = foLineItem.get('fulfillable_quantity', lineItem.shipped)
+            fulfilled = foLineItem.get('quantity', fulfillable) - fulfillable
+            quantity = min(lineItem.shipped - fulfilled, fulfillable)
+
+            if quantity > 0:
+                fulfillmentOrderLineItems.append({
+                    'id': f"gid://shopify/FulfillmentOrderLineItem/{foLineItem['id']}",
+                    'quantity': quantity
+                })
+                shipped_date = lineItem.shipped_date
+
+        return fulfillmentOrderLineItems, shipped_date
 
     def generate_order_metafields(self, order):
         metafield_keys = [
@@ -171,48 +1121,153 @@ class Processor:
         return metafields
 
 
-def list_products(thread=None):
+def list_products():
 
-    processor = Processor(thread=thread)
+    for record in bulk_query(PRODUCTS_BULK_QUERY):
+        yield to_id(record['id'])
 
-    with shopify.Session.temp(SHOPIFY_API_BASE_URL, SHOPIFY_API_VERSION, processor.api_token):
 
-        all_shopify_product_ids = []
-        shopify_products = shopify.Product.find(limit=250)
+def list_product_index():
 
-        while shopify_products:
-
-            print(f"Fetched {len(shopify_products)} Products")
-
-            for shopify_product in shopify_products:
-                all_shopify_product_ids.append(shopify_product.id)
+    query = """
+        {
+            products {
+                edges {
+                    node {
+                        id
+                        handle
+                        updatedAt
+                        variants {
+                            edges {
+                                node {
+                                    id
+                                    sku
+                                    inventoryItem {
+                                        id
+                                    }
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    """
+
+    products = {}
+    for record in bulk_query(query):
+        if '__parentId' not in record:
+            products[record['id']] = record
+            continue
+
+        shopify_product = products.get(record['__parentId'])
+        if not shopify_product or not record['sku']:
+            continue
+
+        yield {
+            "sku": record['sku'],
+            "id": to_id(shopify_product['id']),
+            "handle": shopify_product['handle'],
+            "updated_at": shopify_product['updatedAt'],
+            "variant_id": to_id(record['id']),
+            "inventory_item_id": to_id(record['inventoryItem']['id']),
+        }
 
-            shopify_products = shopify_products.has_next_page(
-            ) and shopify_products.next_page() or []
 
-        return all_shopify_product_ids
+def snapshot_products():
+    # One compact record per variant for `verify`. Products without a single
+    # SKU come through with sku None, so they can be reported as orphans.
+    query = """
+        {
+            products {
+                edges {
+                    node {
+                        id
+                        title
+                        variants {
+                            edges {
+                                node {
+                                    id
+                                    sku
+                                    price
+                                    inventoryItem {
+                                        id
+                                    }
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    """
+
+    products = {}
+    listed = set()
+    for record in bulk_query(query):
+        if '__parentId' not in record:
+            products[record['id']] = record
+            continue
+
+        shopify_product = products.get(record['__parentId'])
+        if not shopify_product or not record['sku']:
+            continue
+
+        listed.add(shopify_product['id'])
+        yield {
+            "sku": record['sku'],
+            "id": to_id(shopify_product['id']),
+            "variant_id": to_id(record['id']),
+            "inventory_item_id": to_id(record['inventoryItem']['id']),
+            "title": shopify_product['title'],
+            "price": record['price'],
+        }
 
+    for id, shopify_product in products.items():
+        if id not in listed:
+            yield {
+                "sku": None,
+                "id": to_id(id),
+                "title": shopify_product['title'],
+            }
 
-def get_product(product_id, thread=None):
 
-    processor = Processor(thread=thread)
+def get_product(product_id):
 
-    with shopify.Session.temp(SHOPIFY_API_BASE_URL, SHOPIFY_API_VERSION, processor.api_token):
+    with session():
 
         shopify_product = shopify.Product.find(product_id)
 
         return shopify_product
-    
 
-def create_product(product, thread=None):
 
-    processor = Processor(thread=thread)
+def find_product(sku):
+
+    with session(cost=0, api=GRAPHQL) as token:
+
+        response = graphql(token, PRODUCT_BY_SKU_QUERY, variables={
+                           "query": f"sku:'{sku}'"}, cost=5)
+
+        variants = response.get('data', {}).get('productVariants', {}).get('nodes', [])
+        if not variants:
+            return None
+
+        variant = variants[0]
+        return to_product_index({
+            **variant['product'],
+            "variants": {"nodes": [variant]},
+        })
+
+
+def create_product(product):
+
+    processor = Processor()
 
     product_data = processor.generate_product_data(product=product)
     variant_data = processor.generate_variant_data(product=product)
     metafields = processor.generate_product_metafields(product=product)
 
-    with shopify.Session.temp(SHOPIFY_API_BASE_URL, SHOPIFY_API_VERSION, processor.api_token):
+    with session(cost=len(metafields) + 2):
 
         shopify_product = shopify.Product()
         for key in product_data.keys():
@@ -245,86 +1300,192 @@ def create_product(product, thread=None):
         return shopify_product
 
 
-def update_product(product, thread=None):
+def create_product_set(product):
 
-    processor = Processor(thread=thread)
+    processor = Processor()
 
-    metafields = processor.generate_product_metafields(product=product)
+    product_input = processor.generate_product_set_input(product=product)
 
-    with shopify.Session.temp(SHOPIFY_API_BASE_URL, SHOPIFY_API_VERSION, processor.api_token):
+    with session(cost=0, api=GRAPHQL) as token:
 
-        shopify_product = shopify.Product.find(product.shopify_id)
+        response = graphql(token, PRODUCT_SET_MUTATION, variables={
+                           "input": product_input}, cost=20)
 
-        if not shopify_product:
-            print(f"Product with ID {product.shopify_id} does not exist.")
+        result = response['data']['productSet']
+        if result['userErrors'] or not result['product']:
+            print(f"{product.product_id}: {result['userErrors']}")
             return None
 
-        existing_metafields = shopify_product.metafields()
+        shopify_product = result['product']
+
+        # Inactive products stay unpublished, as with published_at=None on REST
+        publication_id = get_publication_id(token) if product.status else None
+        if publication_id:
+            graphql(token, PUBLISH_MUTATION, variables={
+                "id": shopify_product['id'],
+                "input": [{"publicationId": publication_id}],
+            })
 
-        for metafield in metafields:
-            for existing_metafield in existing_metafields:
-                if existing_metafield.key == metafield['key']:
-                    existing_metafield.value = metafield['value']
-                    existing_metafield.save()
-                    break
+        return to_product_index(shopify_product)
 
-        return shopify_product
+
+def update_product(product, sections, metafield_keys):
+
+    processor = Processor()
+
+    product_id = to_gid("Product", product.shopify_id)
+    product_input = processor.generate_product_set_input(product=product)
+
+    product_mutation = """
+        mutation productUpdate($input: ProductInput!) {
+            productUpdate(input: $input) {
+                userErrors {
+                    field
+                    message
+                }
+            }
+        }
+    """
+
+    variant_mutation = """
+        mutation productVariantsBulkUpdate($productId: ID!, $variants: [ProductVariantsBulkInput!]!) {
+            productVariantsBulkUpdate(productId: $productId, variants: $variants) {
+                userErrors {
+                    field
+                    message
+                }
+            }
+        }
+    """
+
+    errors = []
+
+    with session(cost=0, api=GRAPHQL) as token:
+
+        if "product" in sections:
+            response = graphql(token, product_mutation, variables={"input": {
+                "id": product_id,
+                "title": product_input['title'],
+                "descriptionHtml": product_input['descriptionHtml'],
+                "vendor": product_input['vendor'],
+                "productType": product_input['productType'],
+                "tags": product_input['tags'],
+            }})
+            errors += response['data']['productUpdate']['userErrors']
+
+        # Quantities are left to the inventory sync
+        if "variant" in sections and product.shopify_variant_id:
+            variant_input = product_input['variants'][0]
+
+            response = graphql(token, variant_mutation, variables={
+                "productId": product_id,
+                "variants": [{
+                    "id": to_gid("ProductVariant", product.shopify_variant_id),
+                    "price": variant_input['price'],
+                    "taxable": variant_input['taxable'],
+                    "inventoryItem": variant_input['inventoryItem'],
+                }],
+            })
+            errors += response['data']['productVariantsBulkUpdate']['userErrors']
+
+        if metafield_keys:
+            metafields = [metafield for metafield in processor.generate_product_metafields(product=product)
+                          if metafield['key'] in metafield_keys]
+            errors += set_metafields(token, product_id, metafields)
+
+    if errors:
+        print(f"{product.product_id}: {errors}")
+
+    return not errors
 
 
-def product_status(thread=None):
+def product_status_mutation(count):
+    # `count` aliased productUpdate calls in one request
+    variables = ", ".join(f"$p{index}: ProductInput!" for index in range(count))
+    updates = "\n".join(f"""
+            p{index}: productUpdate(input: $p{index}) {{
+                userErrors {{
+                    field
+                    message
+                }}
+            }}""" for index in range(count))
 
-    processor = Processor(thread=thread)
+    return f"""
+        mutation productStatus({variables}) {{{updates}
+        }}
+    """
 
-    with shopify.Session.temp(SHOPIFY_API_BASE_URL, SHOPIFY_API_VERSION, processor.api_token):
 
-        shopify_products = shopify.Product.find(limit=250)
+def product_status(workers=20):
 
-        active = 0
-        draft = 0
-        archived = 0
+    query = """
+        {
+            products {
+                edges {
+                    node {
+                        id
+                        handle
+                        status
+                    }
+                }
+            }
+        }
+    """
+
+    # Desired status for every synced product, one query
+    open_orders = LineItem.objects.filter(
+        product=OuterRef('pk'), order__status__in=OPEN_ORDER_STATUSES)
+    desired = {}
+    for shopify_id, status, has_open_orders in Product.objects.exclude(shopify_id=None).annotate(
+            has_open_orders=Exists(open_orders)).values_list('shopify_id', 'status', 'has_open_orders').iterator(chunk_size=2000):
+        if status:
+            desired[str(shopify_id)] = "active"
+        elif has_open_orders:
+            desired[str(shopify_id)] = "draft"
+        else:
+            desired[str(shopify_id)] = "archived"
 
-        while shopify_products:
+    counts = {"active": 0, "draft": 0, "archived": 0}
+    changes = []
 
-            print(f"Fetched {len(shopify_products)} Products")
+    for record in bulk_query(query):
+        # Products Zen Cart doesn't know about are archived
+        status = desired.get(str(to_id(record['id'])), "archived")
+        counts[status] += 1
 
-            for shopify_product in shopify_products:
-                try:
-                    product = Product.objects.get(shopify_id=shopify_product.id)
-                    if not product.status:
-                        lineItems = product.lineItems.filter(order__status__in=["Partial Shipment", "Pending", "Processing"])
-                        if len(lineItems) > 0:
-                            status = "draft"
-                            draft += 1
-                        else:
-                            status = "archived"
-                            archived += 1
-                    else:
-                        status = "active"
-                        active += 1
-                except Product.DoesNotExist:
-                    status = "archived"
-                    archived += 1
+        if record['status'].lower() != status:
+            changes.append((record['id'], record['handle'], status))
 
-                try:
-                    shopify_product.status = status
-                    shopify_product.save()
+    batches = [changes[index:index + PRODUCT_STATUS_BATCH_SIZE]
+               for index in range(0, len(changes), PRODUCT_STATUS_BATCH_SIZE)]
 
-                    print(f"Updated {shopify_product.handle} status to {status}")
-                except Exception as e:
-                    print(e)
+    def update_batch(index, batch):
+        with session(cost=0, api=GRAPHQL) as token:
+            response = graphql(token, product_status_mutation(len(batch)), variables={
+                f"p{position}": {"id": id, "status": status.upper()}
+                for position, (id, _, status) in enumerate(batch)
+            }, cost=10 * len(batch))
 
-            shopify_products = shopify_products.has_next_page(
-            ) and shopify_products.next_page() or []
+        if response.get('errors'):
+            raise Exception(response['errors'])
 
-        print(f"Active: {active}, Draft: {draft}, Archived: {archived}")
+        for position, (_, handle, status) in enumerate(batch):
+            errors = response['data'][f"p{position}"]['userErrors']
+            if errors:
+                print(f"{handle}: {errors}")
+            else:
+                print(f"Updated {handle} status to {status}")
 
+    thread(rows=batches, function=update_batch,
+           workers=workers, label="Product Status")
 
+    print(f"Active: {counts['active']}, Draft: {counts['draft']}, Archived: {counts['archived']}, "
+          f"{len(changes)} changed")
 
-def delete_product(id, thread=None):
 
-    processor = Processor(thread=thread)
+def delete_product(id):
 
-    with shopify.Session.temp(SHOPIFY_API_BASE_URL, SHOPIFY_API_VERSION, processor.api_token):
+    with session(cost=2):
 
         shopify_product = shopify.Product.find(id)
         success = shopify_product.destroy()
@@ -332,11 +1493,9 @@ def delete_product(id, thread=None):
         return success
 
 
-def upload_image(shopify_id, image, alt, thread=None):
+def upload_image(shopify_id, image, alt):
 
-    processor = Processor(thread=thread)
-
-    with shopify.Session.temp(SHOPIFY_API_BASE_URL, SHOPIFY_API_VERSION, processor.api_token):
+    with session():
 
         with open(image, "rb") as image_file:
             encoded_string = base64.b64encode(
@@ -356,22 +1515,23 @@ def upload_image(shopify_id, image, alt, thread=None):
             return shopify_image
 
 
-def update_inventory(product, thread=None):
-
-    processor = Processor(thread=thread)
+def update_inventory(product):
 
-    with shopify.Session.temp(SHOPIFY_API_BASE_URL, SHOPIFY_API_VERSION, processor.api_token):
+    with session(cost=3) as token:
 
         shopify_product = shopify.Product.find(product.shopify_id)
-        for shopify_variant in shopify_product.variants:
+        for index, shopify_variant in enumerate(shopify_product.variants):
+            if index > 0:
+                SCHEDULER.wait(token, cost=2)
+
             inventory_item_id = shopify_variant.inventory_item_id
 
             inventory_levels = shopify.InventoryLevel.find(
-                inventory_item_ids=inventory_item_id, location_ids='76827230447')
+                inventory_item_ids=inventory_item_id, location_ids=SHOPIFY_LOCATION_ID)
 
             if inventory_levels:
                 inventory_level = inventory_levels[0]
-                inventory_level.set(location_id='76827230447',
+                inventory_level.set(location_id=SHOPIFY_LOCATION_ID,
                                     inventory_item_id=inventory_item_id, available=product.quantity)
 
                 print(
@@ -384,11 +1544,31 @@ def update_inventory(product, thread=None):
         return
 
 
-def create_collection(title, rules, thread=None):
+def set_inventory_quantities(quantities, location_id=SHOPIFY_LOCATION_ID):
+    # quantities: [(inventory_item_id, available)], at most INVENTORY_BATCH_SIZE
+
+    with session(cost=0, api=GRAPHQL) as token:
+
+        response = graphql(token, INVENTORY_SET_QUANTITIES_MUTATION, variables={"input": {
+            "name": "available",
+            "reason": "correction",
+            "ignoreCompareQuantity": True,
+            "quantities": [{
+                "inventoryItemId": to_gid("InventoryItem", inventory_item_id),
+                "locationId": to_gid("Location", location_id),
+                "quantity": quantity,
+            } for inventory_item_id, quantity in quantities],
+        }}, cost=10)
+
+        if response.get('errors'):
+            raise Exception(response['errors'])
+
+        return response['data']['inventorySetQuantities']['userErrors']
+
 
-    processor = Processor(thread=thread)
+def create_collection(title, rules):
 
-    with shopify.Session.temp(SHOPIFY_API_BASE_URL, SHOPIFY_API_VERSION, processor.api_token):
+    with session():
 
         shopify_collection = shopify.SmartCollection()
 
@@ -399,76 +1579,56 @@ def create_collection(title, rules, thread=None):
         return shopify_collection
 
 
-def list_customers(thread=None):
+def list_customers():
 
-    processor = Processor(thread=thread)
+    for record in bulk_query(CUSTOMERS_BULK_QUERY):
+        yield to_id(record['id'])
 
-    with shopify.Session.temp(SHOPIFY_API_BASE_URL, SHOPIFY_API_VERSION, processor.api_token):
 
-        all_shopify_customer_ids = []
-        shopify_customers = shopify.Customer.find(limit=250)
-
-        while shopify_customers:
-
-            print(f"Fetched {len(shopify_customers)} Customers")
-
-            for shopify_customer in shopify_customers:
-                all_shopify_customer_ids.append(shopify_customer.id)
-
-            shopify_customers = shopify_customers.has_next_page(
-            ) and shopify_customers.next_page() or []
+def snapshot_customers():
+    query = """
+        {
+            customers {
+                edges {
+                    node {
+                        id
+                        email
+                        firstName
+                        lastName
+                    }
+                }
+            }
+        }
+    """
+
+    for record in bulk_query(query):
+        yield {
+            "email": record['email'],
+            "id": to_id(record['id']),
+            "first_name": record['firstName'],
+            "last_name": record['lastName'],
+        }
 
-        return all_shopify_customer_ids
 
+def find_customer(email):
 
-def create_customer(customer, thread=None):
-    processor = Processor(thread=thread)
+    if not email:
+        return None
 
-    metafields = processor.generate_customer_metafields(customer=customer)
+    with session():
 
-    with shopify.Session.temp(SHOPIFY_API_BASE_URL, SHOPIFY_API_VERSION, processor.api_token):
+        shopify_customers = shopify.Customer.search(query=f"email:{email}", limit=1)
 
-        # Exceptions
-        email = customer.email.replace(" ", "")
+        return shopify_customers[0] if shopify_customers else None
 
-        addresses = []
-        for address in customer.addresses.all():
-            address_obj = {
-                "first_name": address.first_name,
-                "last_name": address.last_name,
-                "company": address.company,
-                "address1": address.address1,
-                "address2": address.address2,
-                "city": address.city,
-                "province": address.state,
-                "zip": address.zip,
-                "country": address.country,
-            }
-            if address.address_id == customer.default_address:
-                address_obj['default'] = True
 
-            addresses.append(address_obj)
+def create_customer(customer):
+    processor = Processor()
 
-        customer_data = {
-            "email": email,
-            "phone": customer.phone,
-            "first_name": customer.first_name,
-            "last_name": customer.last_name,
-            "addresses": addresses,
-            "note": customer.note,
-            "tags": customer.tags,
-        }
+    metafields = processor.generate_customer_metafields(customer=customer)
+    customer_data = processor.generate_customer_data(customer=customer)
 
-        if customer.newsletter:
-            customer_data["email_marketing_consent"] = {
-                "state": "subscribed",
-                "opt_in_level": "confirmed_opt_in",
-            }
-        if customer.sms and customer.phone:
-            customer_data["sms_marketing_consent"] = {
-                "state": "subscribed",
-                "opt_in_level": "single_opt_in",
-            }
+    with session(cost=len(metafields) + 1) as token:
 
         shopify_customer = shopify.Customer(customer_data)
 
@@ -494,6 +1654,7 @@ def create_customer(customer, thread=None):
 
             shopify_customer = shopify.Customer(customer_data)
 
+            SCHEDULER.wait(token, cost=len(metafields) + 1)
             if shopify_customer.save():
 
                 for metafield in metafields:
@@ -509,148 +1670,151 @@ def create_customer(customer, thread=None):
         return shopify_customer
 
 
-def delete_customer(id, thread=None):
+def update_customer(customer, sections, metafield_keys):
 
-    processor = Processor(thread=thread)
+    processor = Processor()
 
-    with shopify.Session.temp(SHOPIFY_API_BASE_URL, SHOPIFY_API_VERSION, processor.api_token):
+    customer_id = to_gid("Customer", customer.shopify_id)
+    customer_data = processor.generate_customer_data(customer=customer)
 
-        shopify_customer = shopify.Customer.find(id)
+    mutation = """
+        mutation customerUpdate($input: CustomerInput!) {
+            customerUpdate(input: $input) {
+                userErrors {
+                    field
+                    message
+                }
+            }
+        }
+    """
+
+    errors = []
+
+    with session(cost=0, api=GRAPHQL) as token:
+
+        # Marketing consent is only set when the customer is created
+        if "customer" in sections or "addresses" in sections:
+            customer_input = {
+                "id": customer_id,
+                "email": customer_data['email'],
+                "phone": customer_data['phone'] or None,
+                "firstName": customer_data['first_name'],
+                "lastName": customer_data['last_name'],
+                "note": customer_data['note'],
+                "tags": customer_data['tags'].split(",") if customer_data['tags'] else [],
+            }
 
-        success = shopify_customer.destroy()
+            if "addresses" in sections:
+                customer_input['addresses'] = [{
+                    "firstName": address['first_name'],
+                    "lastName": address['last_name'],
+                    "company": address['company'],
+                    "address1": address['address1'],
+                    "address2": address['address2'],
+                    "city": address['city'],
+                    "province": address['province'],
+                    "zip": address['zip'],
+                    "country": address['country'],
+                } for address in customer_data['addresses']]
 
-        return success
+            response = graphql(token, mutation, variables={
+                               "input": customer_input})
+            errors += response['data']['customerUpdate']['userErrors']
 
+        if metafield_keys:
+            metafields = [metafield for metafield in processor.generate_customer_metafields(customer=customer)
+                          if metafield['key'] in metafield_keys]
+            errors += set_metafields(token, customer_id, metafields)
 
-def list_orders(thread=None):
+    if errors:
+        print(f"{customer}: {errors}")
 
-    processor = Processor(thread=thread)
+    return not errors
 
-    with shopify.Session.temp(SHOPIFY_API_BASE_URL, SHOPIFY_API_VERSION, processor.api_token):
 
-        all_shopify_order_ids = []
-        shopify_orders = shopify.Order.find(limit=250, status="any")
+def delete_customer(id):
 
-        while shopify_orders:
+    with session(cost=2):
 
-            print(f"Fetched {len(shopify_orders)} Orders.")
+        shopify_customer = shopify.Customer.find(id)
 
-            for shopify_order in shopify_orders:
-                all_shopify_order_ids.append(shopify_order.id)
+        success = shopify_customer.destroy()
 
-            shopify_orders = shopify_orders.has_next_page(
-            ) and shopify_orders.next_page() or []
+        return success
 
-        return all_shopify_order_ids
 
+def list_orders():
 
-def get_order(id, thread=None):
+    for record in bulk_query(ORDERS_BULK_QUERY):
+        yield to_id(record['id'])
 
-    processor = Processor(thread=thread)
 
-    with shopify.Session.temp(SHOPIFY_API_BASE_URL, SHOPIFY_API_VERSION, processor.api_token):
+def snapshot_orders():
+    # Orders are matched on the zencart-<id> tag every sync path sets
+    query = """
+        {
+            orders {
+                edges {
+                    node {
+                        id
+                        name
+                        tags
+                        totalPriceSet {
+                            shopMoney {
+                                amount
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    """
 
-        shopify_order = shopify.Order.find(id)
-        return shopify_order
+    prefix = to_order_tag("")
+    for record in bulk_query(query):
+        order_ids = [tag[len(prefix):] for tag in record['tags'] if tag.startswith(prefix)]
 
+        yield {
+            "order_id": int(order_ids[0]) if order_ids and order_ids[0].isdigit() else None,
+            "id": to_id(record['id']),
+            "order_number": to_order_number(record['name']),
+            "total": record['totalPriceSet']['shopMoney']['amount'],
+        }
 
-def create_order(order, thread=None):
-    processor = Processor(thread=thread)
 
-    # metafields = processor.generate_order_metafields(order=order)
+def find_order(order_id):
 
-    with shopify.Session.temp(SHOPIFY_API_BASE_URL, SHOPIFY_API_VERSION, processor.api_token):
+    with session(cost=0, api=GRAPHQL) as token:
 
-        shopify_order = shopify.Order()
+        response = graphql(token, ORDER_BY_TAG_QUERY, variables={
+                           "query": f"tag:'{to_order_tag(order_id)}'"}, cost=5)
 
-        # Customer
-        shopify_order.customer = {
-            "id": order.customer.shopify_id
-        }
-        shopify_order.phone = order.customer.phone
+        orders = response.get('data', {}).get('orders', {}).get('nodes', [])
+        if not orders:
+            return None
 
-        # Line Items
-        line_items = []
-        for item in order.lineItems.all():
-            try:
-                shopify_product = shopify.Product.find(item.product.shopify_id)
-                variant_id = shopify_product.variants[0].id
-            except Exception as e:
-                print(e)
-                continue
+        SCHEDULER.wait(token)
+        return shopify.Order.find(to_id(orders[0]['id']))
 
-            line_item = shopify.LineItem({
-                "variant_id": variant_id,
-                "price": item.unit_price,
-                "quantity": item.quantity,
-            })
-            line_items.append(line_item)
-        shopify_order.line_items = line_items
 
-        # Costs
-        if not order.shipping_price < 0:
-            shopify_order.shipping_lines = [{
-                "title": order.shipping_method or "FedEx",
-                "price": order.shipping_price
-            }]
-        shopify_order.tax_lines = [{
-            'price': order.tax
-        }]
-        shopify_order.total_price = order.total_price
-        if order.order_date:
-            shopify_order.created_at = order.order_date.isoformat()
+def get_order(id):
 
-        # Shipping Address
-        if order.shipping_address_id:
-            try:
-                shipping_address = Address.objects.get(
-                    address_id=order.shipping_address_id)
+    with session():
 
-                shopify_order.shipping_address = {
-                    'first_name': shipping_address.first_name,
-                    'last_name': shipping_address.last_name,
-                    'company': shipping_address.company,
-                    'address1': shipping_address.address1,
-                    'address2': shipping_address.address2,
-                    'city': shipping_address.city,
-                    'province': shipping_address.state,
-                    'zip': shipping_address.zip,
-                    'country': shipping_address.country,
-                    'phone': shipping_address.customer.phone
-                }
-            except Exception as e:
-                print(e)
-                pass
+        shopify_order = shopify.Order.find(id)
+        return shopify_order
 
-        # Billing Address
-        shopify_order.billing_address = {
-            'name': order.billing_name,
-            'company': order.billing_company,
-            'address1': order.billing_address1,
-            'address2': order.billing_address2,
-            'city': order.billing_city,
-            'province': order.billing_state,
-            'zip': order.billing_zip,
-            'country': order.billing_country,
-        }
 
-        # Order Status
-        if order.status == "Cancelled":
-            shopify_order.fulfillment_status = "restocked"
-            shopify_order.financial_status = "refunded"
-        elif order.status == "Delivered":
-            shopify_order.financial_status = "paid"
-        elif order.status == "Partial Shipment":
-            shopify_order.financial_status = "paid"
-        elif order.status == "Pending":
-            shopify_order.financial_status = "pending"
-        elif order.status == "Processing":
-            shopify_order.financial_status = "paid"
-        else:
-            shopify_order.financial_status = "pending"
+def create_order(order):
+    processor = Processor()
 
-        # Order Note
-        shopify_order.note = f"Zencart Order ID: {order.order_id}"
+    # metafields = processor.generate_order_metafields(order=order)
+
+    order_data = processor.generate_order_data(order=order)
+
+    with session():
+
+        shopify_order = shopify.Order(order_data)
 
         # Metafields
         if shopify_order.save():
@@ -660,7 +1824,7 @@ def create_order(order, thread=None):
             #     shopify_metafield.key = metafield['key']
             #     shopify_metafield.value = metafield['value']
             #     shopify_order.add_metafield(shopify_metafield)
-            
+
             pass
 
         else:
@@ -668,50 +1832,125 @@ def create_order(order, thread=None):
 
         return shopify_order
 
-    
-def fulfill_order(order, thread=None):
-    processor = Processor(thread=thread)
 
-    with shopify.Session.temp(SHOPIFY_API_BASE_URL, SHOPIFY_API_VERSION, processor.api_token):
+def create_order_graphql(order):
+    processor = Processor()
 
-        graphQL = shopify.GraphQL()
+    order_input = processor.generate_order_create_input(order=order)
 
-        fo = [fo for fo in shopify.FulfillmentOrders.find(order_id=order.shopify_id) if fo.status == "open" or fo.status == "in_progress"][0]
+    with session(cost=0, api=GRAPHQL) as token:
 
-        mutation = """
-            mutation fulfillmentCreateV2($fulfillment: FulfillmentV2Input!) {
-                fulfillmentCreateV2(fulfillment: $fulfillment) {
-                    fulfillment {
-                        id
-                        status
-                    }
-                    userErrors {
-                        field
-                        message
-                    }
-                }
-            }
-        """
+        response = graphql(token, ORDER_CREATE_MUTATION, variables={
+            "order": order_input,
+            "options": processor.generate_order_create_options(),
+        }, cost=10)
 
-        fulfillmentOrderLineItems = []
-        shipped_date = None
-        for foLineItem in fo.line_items:
-            variant = shopify.Variant.find(foLineItem.variant_id)
+        # Throttling and server errors are worth another attempt
+        if response.get('errors'):
+            raise Exception(response['errors'])
+
+        result = response['data']['orderCreate']
+        if result['userErrors'] or not result['order']:
+            print(f"{order.order_id}: {result['userErrors']}")
+            return None
+
+        return {
+            "id": to_id(result['order']['id']),
+            "order_number": to_order_number(result['order']['name']),
+        }
+
+
+def staged_upload(filename, path):
+    # Upload a JSONL file for bulkOperationRunMutation, returns its staged path
+
+    with session(cost=0, api=GRAPHQL) as token:
+
+        response = graphql(token, STAGED_UPLOADS_MUTATION, variables={"input": [{
+            "resource": "BULK_MUTATION_VARIABLES",
+            "filename": filename,
+            "mimeType": "text/jsonl",
+            "httpMethod": "POST",
+        }]})
+
+        result = response['data']['stagedUploadsCreate']
+        if result['userErrors']:
+            raise Exception(result['userErrors'])
+
+        target = result['stagedTargets'][0]
+
+    parameters = {parameter['name']: parameter['value']
+                  for parameter in target['parameters']}
+
+    with open(path, "rb") as f:
+        response = requests.post(target['url'], data=parameters, files={
+                                 "file": (filename, f)}, timeout=600)
+        response.raise_for_status()
 
-            for lineItem in order.lineItems.all():
-                sku = lineItem.product.product_id
+    return parameters['key']
 
-                if lineItem.shipped > 0 and sku == variant.sku:
-                    fulfillmentOrderLineItems.append({
-                        'id': f"gid://shopify/FulfillmentOrderLineItem/{foLineItem.id}",
-                        'quantity': lineItem.shipped
-                    })
-                    shipped_date = lineItem.shipped_date
-                    break
+
+def bulk_mutation(mutation, path):
+    # Run `mutation` once per JSONL line of `path`, yields each result line
+
+    staged_upload_path = staged_upload(os.path.basename(path), path)
+
+    with session(cost=0, api=GRAPHQL) as token:
+
+        response = graphql(token, BULK_MUTATION_MUTATION, variables={
+            "mutation": mutation,
+            "stagedUploadPath": staged_upload_path,
+        })
+
+        result = response['data']['bulkOperationRunMutation']
+        if result['userErrors']:
+            raise Exception(result['userErrors'])
+
+        operation_id = result['bulkOperation']['id']
+
+        while True:
+            time.sleep(BULK_POLL_INTERVAL)
+
+            response = graphql(token, BULK_POLL_QUERY, variables={
+                               "id": operation_id}, cost=1)
+            operation = response['data']['node']
+
+            print(
+                f"Bulk mutation {operation['status']}: {operation['objectCount']} objects")
+
+            if operation['status'] == "COMPLETED":
+                url = operation['url']
+                break
+
+            if operation['status'] in ["FAILED", "CANCELED", "EXPIRED"]:
+                raise Exception(
+                    f"Bulk mutation {operation_id} {operation['status']}: {operation['errorCode']}")
+
+    if not url:
+        return
+
+    yield from stream_jsonl(url)
+
+
+def fulfill_order(order):
+
+    processor = Processor()
+
+    shipped = processor.generate_shipped_items(order=order)
+
+    with session() as token:
+
+        fos = [fo for fo in shopify.FulfillmentOrders.find(order_id=order.shopify_id) if fo.status == "open" or fo.status == "in_progress"]
+        if not fos:
+            return None
+
+        fo = fos[0]
+
+        fulfillmentOrderLineItems, shipped_date = processor.generate_fulfillment_line_items(
+            fo_line_items=[foLineItem.to_dict() for foLineItem in fo.line_items], shipped=shipped)
 
         if len(fulfillmentOrderLineItems) > 0:
 
-            graphql_response = graphQL.execute(mutation, variables={
+            response = graphql(token, FULFILLMENT_CREATE_MUTATION, variables={
                 "fulfillment": {
                     "lineItemsByFulfillmentOrder": {
                         "fulfillmentOrderId": f"gid://shopify/FulfillmentOrder/{fo.id}",
@@ -720,40 +1959,17 @@ def fulfill_order(order, thread=None):
                     "notifyCustomer": False,
                 }
             })
-            response = json.loads(graphql_response)
 
             fulfillment = response['data']['fulfillmentCreateV2']['fulfillment']
 
-            print(fulfillment)
-
             # fulfillment Event
-            mutation = """
-                mutation fulfillmentEventCreate($fulfillmentEvent: FulfillmentEventInput!) {
-                    fulfillmentEventCreate(fulfillmentEvent: $fulfillmentEvent) {
-                        fulfillmentEvent {
-                            id
-                            status
-                            message
-                        }
-                        userErrors {
-                            field
-                            message
-                        }
-                    }
-                }
-            """
-            graphql_response = graphQL.execute(mutation, variables={
+            graphql(token, FULFILLMENT_EVENT_MUTATION, variables={
                 "fulfillmentEvent": {
                     "fulfillmentId": fulfillment['id'],
                     "status": "DELIVERED",
                     "happenedAt": shipped_date.isoformat() if shipped_date else None
                 }
             })
-            response = json.loads(graphql_response)
-
-            fulfillmentEvent = response['data']['fulfillmentEventCreate']['fulfillmentEvent']
-
-            print(fulfillmentEvent)
 
             return fulfillment
 
@@ -761,11 +1977,9 @@ def fulfill_order(order, thread=None):
             return None
 
 
-def delete_order(id, thread=None):
-
-    processor = Processor(thread=thread)
+def delete_order(id):
 
-    with shopify.Session.temp(SHOPIFY_API_BASE_URL, SHOPIFY_API_VERSION, processor.api_token):
+    with session(cost=2):
 
         shopify_order = shopify.Order.find(id)
 
@@ -0,0 +1,471 @@
+import os
+import json
+import base64
+import asyncio
+import itertools
+from urllib.parse import quote
+
+import aiohttp
+from asgiref.sync import sync_to_async
+
+from utils.common import Progress
+from utils.journal import Rejected
+from utils.scheduler import REST, GRAPHQL
+from utils.shopify import (
+    SCHEDULER,
+    SHOPIFY_API_BASE_URL,
+    SHOPIFY_API_VERSION,
+    SHOPIFY_LOCATION_ID,
+    CALL_LIMIT_HEADER,
+    BULK_POLL_INTERVAL,
+    BULK_QUERY_MUTATION,
+    BULK_POLL_QUERY,
+    PRODUCT_SET_MUTATION,
+    PUBLICATIONS_QUERY,
+    PUBLISH_MUTATION,
+    FULFILLMENT_CREATE_MUTATION,
+    FULFILLMENT_EVENT_MUTATION,
+    ORDER_CREATE_MUTATION,
+    PRODUCTS_BULK_QUERY,
+    PRODUCT_BY_SKU_QUERY,
+    ORDER_BY_TAG_QUERY,
+    CUSTOMERS_BULK_QUERY,
+    ORDERS_BULK_QUERY,
+    Processor,
+    to_id,
+    to_metafield_input,
+    to_product_index,
+    to_order_tag,
+    to_order_number,
+)
+
+MAX_RETRIES = 5
+
+
+class HTTPError(Exception):
+    # Carries the status and headers so the journal can tell retryable failures
+    def __init__(self, message, status, headers):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers
+
+
+class Engine:
+    def __init__(self, concurrency=200, token_concurrency=40):
+        self.concurrency = concurrency
+        self.token_concurrency = token_concurrency
+
+        host = str(SHOPIFY_API_BASE_URL).replace(
+            "https://", "").replace("http://", "").strip("/")
+        self.base_url = f"https://{host}/admin/api/{SHOPIFY_API_VERSION}"
+
+        self.in_flight = {token: 0 for token in SCHEDULER.tokens}
+        self.publication_id = None
+
+    async def __aenter__(self):
+        # One keep-alive pool for every request the process makes
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self.concurrency, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=120),
+            json_serialize=lambda data: json.dumps(data, default=str),
+        )
+        self.condition = asyncio.Condition()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.session.close()
+
+    def free_tokens(self):
+        # Also respect the shared scheduler's limit so reserve() never blocks the loop
+        return [token for token in SCHEDULER.free_tokens()
+                if self.in_flight[token] < self.token_concurrency]
+
+    async def lease(self, cost=1, api=REST):
+        async with self.condition:
+            await self.condition.wait_for(self.free_tokens)
+
+            token, wait = SCHEDULER.reserve(
+                cost=cost, api=api, tokens=self.free_tokens())
+            self.in_flight[token] += 1
+
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+        return token
+
+    async def release(self, token):
+        SCHEDULER.release(token)
+
+        async with self.condition:
+            self.in_flight[token] -= 1
+            self.condition.notify()
+
+    async def rest(self, method, path, payload=None, cost=1):
+        for _ in range(MAX_RETRIES):
+            token = await self.lease(cost=cost, api=REST)
+
+            try:
+                async with self.session.request(method, f"{self.base_url}/{path}", json=payload, headers={
+                    "X-Shopify-Access-Token": token,
+                    "Accept": "application/json",
+                }) as response:
+                    headers = {key.lower(): value for key,
+                               value in response.headers.items()}
+                    SCHEDULER.observe_rest(
+                        token, headers.get(CALL_LIMIT_HEADER))
+
+                    if response.status == 429:
+                        SCHEDULER.throttled(
+                            token, api=REST, retry_after=headers.get("retry-after"))
+                        continue
+
+                    text = await response.text()
+                    body = json.loads(text) if text.strip() else {}
+
+                    message = f"{method} {path}: {response.status} {body.get('errors', body)}"
+                    if response.status == 422:
+                        raise Rejected(message)
+                    if response.status >= 400:
+                        raise HTTPError(message, response.status, headers)
+
+                    return body
+            finally:
+                await self.release(token)
+
+        raise Exception(f"{method} {path}: throttled {MAX_RETRIES} times")
+
+    async def graphql(self, query, variables=None, cost=10):
+        for _ in range(MAX_RETRIES):
+            token = await self.lease(cost=cost, api=GRAPHQL)
+
+            try:
+                async with self.session.post(f"{self.base_url}/graphql.json", json={
+                    "query": query,
+                    "variables": variables,
+                }, headers={
+                    "X-Shopify-Access-Token": token,
+                }) as response:
+                    if response.status == 429:
+                        SCHEDULER.throttled(token, api=GRAPHQL)
+                        continue
+
+                    response.raise_for_status()
+                    body = await response.json()
+            finally:
+                await self.release(token)
+
+            SCHEDULER.observe_graphql(token, body.get(
+                'extensions', {}).get('cost', {}).get('throttleStatus'))
+
+            errors = body.get('errors', [])
+            if any(error.get('extensions', {}).get('code') == "THROTTLED" for error in errors):
+                SCHEDULER.throttled(token, api=GRAPHQL)
+                continue
+
+            if errors:
+                raise Exception(errors)
+
+            return body['data']
+
+        raise Exception(f"GraphQL throttled {MAX_RETRIES} times")
+
+    async def bulk_query(self, query):
+        data = await self.graphql(BULK_QUERY_MUTATION, variables={"query": query})
+
+        result = data['bulkOperationRunQuery']
+        if result['userErrors']:
+            raise Exception(result['userErrors'])
+
+        operation_id = result['bulkOperation']['id']
+
+        while True:
+            await asyncio.sleep(BULK_POLL_INTERVAL)
+
+            data = await self.graphql(BULK_POLL_QUERY, variables={"id": operation_id}, cost=1)
+            operation = data['node']
+
+            if operation['status'] == "COMPLETED":
+                break
+
+            if operation['status'] in ["FAILED", "CANCELED", "EXPIRED"]:
+                raise Exception(
+                    f"Bulk operation {operation_id} {operation['status']}: {operation['errorCode']}")
+
+        if not operation['url']:
+            return
+
+        async with self.session.get(operation['url']) as response:
+            response.raise_for_status()
+
+            async for line in response.content:
+                if line.strip():
+                    yield json.loads(line)
+
+    async def list_ids(self, query):
+        async for record in self.bulk_query(query):
+            yield to_id(record['id'])
+
+    def list_products(self):
+        return self.list_ids(PRODUCTS_BULK_QUERY)
+
+    def list_customers(self):
+        return self.list_ids(CUSTOMERS_BULK_QUERY)
+
+    def list_orders(self):
+        return self.list_ids(ORDERS_BULK_QUERY)
+
+    async def get_publication_id(self):
+        if self.publication_id is None:
+            data = await self.graphql(PUBLICATIONS_QUERY, cost=5)
+
+            for publication in data['publications']['nodes']:
+                if publication['name'] == "Online Store":
+                    self.publication_id = publication['id']
+
+        return self.publication_id
+
+    async def create_product(self, product_input, publish=True):
+        data = await self.graphql(PRODUCT_SET_MUTATION, variables={"input": product_input}, cost=20)
+
+        result = data['productSet']
+        if result['userErrors'] or not result['product']:
+            raise Rejected(result['userErrors'])
+
+        shopify_product = result['product']
+
+        publication_id = await self.get_publication_id() if publish else None
+        if publication_id:
+            await self.graphql(PUBLISH_MUTATION, variables={
+                "id": shopify_product['id'],
+                "input": [{"publicationId": publication_id}],
+            })
+
+        return to_product_index(shopify_product)
+
+    async def find_product(self, sku):
+        data = await self.graphql(PRODUCT_BY_SKU_QUERY, variables={"query": f"sku:'{sku}'"}, cost=5)
+
+        variants = data['productVariants']['nodes']
+        if not variants:
+            return None
+
+        variant = variants[0]
+        return to_product_index({
+            **variant['product'],
+            "variants": {"nodes": [variant]},
+        })
+
+    async def delete_product(self, id):
+        return await self.rest("DELETE", f"products/{id}.json")
+
+    async def upload_image(self, shopify_id, image, alt):
+        with open(image, "rb") as image_file:
+            encoded_string = base64.b64encode(
+                image_file.read()).decode('utf-8')
+
+        body = await self.rest("POST", f"products/{shopify_id}/images.json", payload={"image": {
+            'attachment': encoded_string,
+            'filename': os.path.basename(image),
+            'alt': alt,
+            'position': 2,
+        }})
+
+        return body['image']
+
+    async def update_inventory(self, inventory_item_id, quantity):
+        body = await self.rest("POST", "inventory_levels/set.json", payload={
+            "location_id": SHOPIFY_LOCATION_ID,
+            "inventory_item_id": inventory_item_id,
+            "available": quantity,
+        })
+
+        return body['inventory_level']
+
+    async def create_customer(self, customer_data, metafields):
+        # REST accepts metafields inline, so the customer is a single request
+        customer_data = dict(customer_data)
+        customer_data['metafields'] = [to_metafield_input(metafield) for metafield in metafields
+                                       if metafield['value'] not in [None, ""]]
+
+        try:
+            body = await self.rest("POST", "customers.json", payload={"customer": customer_data})
+        except Rejected as e:
+            if 'phone' not in customer_data and 'sms_marketing_consent' not in customer_data:
+                raise
+
+            # Invalid phone numbers are the usual rejection, retry without them.
+            # Anything else may have created the customer, the journal retries
+            # and reconciles it.
+            print(f"{customer_data.get('email')}: {e}")
+            customer_data.pop('phone', None)
+            customer_data.pop('sms_marketing_consent', None)
+
+            body = await self.rest("POST", "customers.json", payload={"customer": customer_data})
+
+        return body['customer']
+
+    async def find_customer(self, email):
+        if not email:
+            return None
+
+        body = await self.rest("GET", f"customers/search.json?query={quote(f'email:{email}')}&limit=1")
+
+        customers = body['customers']
+        return customers[0] if customers else None
+
+    async def delete_customer(self, id):
+        return await self.rest("DELETE", f"customers/{id}.json")
+
+    async def create_order(self, order_data):
+        body = await self.rest("POST", "orders.json", payload={"order": order_data})
+
+        return body['order']
+
+    async def create_order_graphql(self, order_input, options):
+        data = await self.graphql(ORDER_CREATE_MUTATION, variables={
+            "order": order_input,
+            "options": options,
+        }, cost=10)
+
+        result = data['orderCreate']
+        if result['userErrors'] or not result['order']:
+            raise Rejected(result['userErrors'])
+
+        return {
+            "id": to_id(result['order']['id']),
+            "order_number": to_order_number(result['order']['name']),
+        }
+
+    async def find_order(self, order_id):
+        data = await self.graphql(ORDER_BY_TAG_QUERY, variables={
+            "query": f"tag:'{to_order_tag(order_id)}'"}, cost=5)
+
+        orders = data['orders']['nodes']
+        if not orders:
+            return None
+
+        body = await self.rest("GET", f"orders/{to_id(orders[0]['id'])}.json")
+        return body['order']
+
+    async def delete_order(self, id):
+        return await self.rest("DELETE", f"orders/{id}.json")
+
+    async def fulfill_order(self, order_id, shipped):
+        body = await self.rest("GET", f"orders/{order_id}/fulfillment_orders.json")
+
+        fos = [fo for fo in body['fulfillment_orders']
+               if fo['status'] == "open" or fo['status'] == "in_progress"]
+        if not fos:
+            return None
+
+        fo = fos[0]
+
+        fulfillmentOrderLineItems, shipped_date = Processor().generate_fulfillment_line_items(
+            fo_line_items=fo['line_items'], shipped=shipped)
+
+        if not fulfillmentOrderLineItems:
+            return None
+
+        data = await self.graphql(FULFILLMENT_CREATE_MUTATION, variables={
+            "fulfillment": {
+                "lineItemsByFulfillmentOrder": {
+                    "fulfillmentOrderId": f"gid://shopify/FulfillmentOrder/{fo['id']}",
+                    "fulfillmentOrderLineItems": fulfillmentOrderLineItems
+                },
+                "notifyCustomer": False,
+            }
+        })
+
+        fulfillment = data['fulfillmentCreateV2']['fulfillment']
+
+        await self.graphql(FULFILLMENT_EVENT_MUTATION, variables={
+            "fulfillmentEvent": {
+                "fulfillmentId": fulfillment['id'],
+                "status": "DELIVERED",
+                "happenedAt": shipped_date.isoformat() if shipped_date else None
+            }
+        })
+
+        return fulfillment
+
+
+async def run(rows, function, concurrency=200, label="Rows"):
+    # Same contract as common.thread: function(index, row), rows pulled lazily.
+    # Rows are read in chunks on Django's sync thread, since the ORM is not
+    # async-safe.
+    progress = Progress(label)
+    slots = asyncio.Semaphore(concurrency)
+
+    iterator = iter(rows)
+    fetch = sync_to_async(lambda: list(itertools.islice(iterator, 500)))
+
+    async def work(index, row):
+        try:
+            await function(index, row)
+        except Exception as e:
+            print(f"{label} {index} failed: {e}")
+            progress.done(index, row, error=e)
+        else:
+            progress.done(index, row)
+        finally:
+            slots.release()
+
+    tasks = set()
+    index = 0
+
+    chunk = await fetch()
+    while chunk:
+        for row in chunk:
+            await slots.acquire()
+
+            progress.submitted += 1
+            task = asyncio.create_task(work(index, row))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+            index += 1
+
+        chunk = await fetch()
+
+    await asyncio.gather(*tasks)
+
+    progress.report()
+
+    return progress
+
+
+async def run_async_rows(rows, function, concurrency=200, label="Rows"):
+    # For rows that come from an async generator, e.g. a bulk listing
+    progress = Progress(label)
+    slots = asyncio.Semaphore(concurrency)
+
+    async def work(index, row):
+        try:
+            await function(index, row)
+        except Exception as e:
+            print(f"{label} {index} failed: {e}")
+            progress.done(index, row, error=e)
+        else:
+            progress.done(index, row)
+        finally:
+            slots.release()
+
+    tasks = set()
+    index = 0
+
+    async for row in rows:
+        await slots.acquire()
+
+        progress.submitted += 1
+        task = asyncio.create_task(work(index, row))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+        index += 1
+
+    await asyncio.gather(*tasks)
+
+    progress.report()
+
+    return progress
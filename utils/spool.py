@@ -0,0 +1,172 @@
+import os
+import json
+import itertools
+from datetime import date
+from types import SimpleNamespace
+
+from utils import shopify
+from vendor.models import Address, LineItem
+
+SPOOLDIR = os.getenv('SPOOL_DIR', f"{shopify.FILEDIR}/spool")
+
+CHUNK_SIZE = 2000
+
+# Primary key of each entity's records
+KEYS = {
+    "products": "product_id",
+    "customers": "customer_id",
+    "orders": "order_id",
+}
+
+
+def path(entity):
+    return f"{SPOOLDIR}/{entity}.jsonl"
+
+
+def write(entity, records):
+    # Written next to the spool and swapped in, so a failed compile never
+    # leaves a half-written file for the senders
+    os.makedirs(SPOOLDIR, exist_ok=True)
+
+    target = path(entity)
+    count = 0
+    with open(f"{target}.tmp", "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, default=str) + "\n")
+            count += 1
+
+    os.replace(f"{target}.tmp", target)
+
+    return count
+
+
+def read(entity):
+    with open(path(entity), encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def chunks(rows, size=CHUNK_SIZE):
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def select(entity, pending_ids):
+    # Ids of the spooled records still pending, records sent or rejected
+    # since the compile are left out. Also whether any of the orders have
+    # line items that no longer match their products' variants.
+    key = KEYS[entity]
+
+    selected = set()
+    stale = False
+    for chunk in chunks(read(entity)):
+        chunk = [record for record in chunk if record[key] in pending_ids]
+        selected.update(record[key] for record in chunk)
+
+        if entity == "orders" and not stale:
+            stale = changed_orders(chunk)
+
+    return selected, stale
+
+
+def changed_orders(records):
+    variants = {}
+    for order_id, variant_id in LineItem.objects.filter(order_id__in=[record['order_id'] for record in records]).values_list(
+            'order_id', 'product__shopify_variant_id'):
+        variants.setdefault(order_id, []).append(int(variant_id))
+
+    return any(sorted(variants.get(record['order_id'], [])) != sorted(
+        item['variant_id'] for item in record['data']['line_items']) for record in records)
+
+
+# Records: everything a sender needs, rendered from local data
+
+def product_record(processor, product):
+    return {
+        "product_id": product.product_id,
+        "name": product.name,
+        "status": product.status,
+        "roomset": product.roomset,
+        "input": processor.generate_product_set_input(product=product),
+        "fingerprint": processor.generate_product_fingerprint(product=product),
+    }
+
+
+def customer_record(processor, customer):
+    record = {
+        "customer_id": customer.customer_id,
+        "email": customer.email,
+        "data": processor.generate_customer_data(customer=customer),
+        "metafields": processor.generate_customer_metafields(customer=customer),
+        "fingerprint": processor.generate_customer_fingerprint(customer=customer),
+    }
+
+    # Shopify drops phone numbers it can't parse, the customer is then saved
+    # without one
+    if customer.phone:
+        phone = customer.phone
+        customer.phone = None
+        record['fingerprint_without_phone'] = processor.generate_customer_fingerprint(
+            customer=customer)
+        customer.phone = phone
+
+    return record
+
+
+def order_record(processor, order):
+    return {
+        "order_id": order.order_id,
+        "status": order.status,
+        "data": processor.generate_order_data(order=order),
+        "create": processor.generate_order_create_input(order=order),
+        "shipped": {variant_id: {"shipped": line_item.shipped, "shipped_date": line_item.shipped_date}
+                    for variant_id, line_item in processor.generate_shipped_items(order=order).items()},
+        "fingerprint": processor.generate_order_fingerprint(order=order),
+    }
+
+
+def to_shipped(record):
+    # Back to what Processor.generate_fulfillment_line_items expects
+    return {variant_id: SimpleNamespace(
+        shipped=item['shipped'],
+        shipped_date=date.fromisoformat(
+            item['shipped_date']) if item['shipped_date'] else None,
+    ) for variant_id, item in record['shipped'].items()}
+
+
+# Compile: large prefetched chunks, one spool file per entity
+
+def compile_products(products, chunk_size=CHUNK_SIZE):
+    processor = shopify.Processor()
+
+    products = products.select_related(
+        'type').prefetch_related('categories', 'tags')
+    for product in products.iterator(chunk_size=chunk_size):
+        yield product_record(processor, product)
+
+
+def compile_customers(customers, chunk_size=CHUNK_SIZE):
+    processor = shopify.Processor()
+
+    customers = customers.prefetch_related('addresses')
+    for customer in customers.iterator(chunk_size=chunk_size):
+        yield customer_record(processor, customer)
+
+
+def compile_orders(orders, chunk_size=CHUNK_SIZE):
+    orders = orders.select_related(
+        'customer').prefetch_related('lineItems__product')
+
+    for chunk in chunks(orders.iterator(chunk_size=chunk_size), chunk_size):
+        # Shipping addresses are plain ids on the order, loaded per chunk
+        addresses = Address.objects.select_related('customer').in_bulk(
+            {order.shipping_address_id for order in chunk if order.shipping_address_id})
+
+        processor = shopify.Processor(addresses=addresses)
+        for order in chunk:
+            yield order_record(processor, order)